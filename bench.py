@@ -0,0 +1,651 @@
+'''Benchmarks for midi.py.
+
+Run `python bench.py` from the repo root. Pass MIDI files to also benchmark against them, and --json PATH to write the suite's results as JSON.'''
+
+import midi
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+def synth_track(seed, notes=20000, polyphony=8):
+    'Deterministic dense track of overlapping notes, like a busy piano part.'
+    rng = random.Random(seed)
+    song = midi.Song(track_count=1)
+    ticks = 0
+    for i in range(notes):
+        ticks += rng.choice([0, 0, 30, 60, 90])
+        num = rng.randrange(60, 60 + polyphony)
+        song.tracks[0].append(midi.Deltamsg(None, midi.Msg.note_on(num).bytes, ticks))
+        song.tracks[0].append(midi.Deltamsg(None, midi.Msg.note_off(num).bytes, ticks + rng.randrange(1, 400)))
+    song.tracks[0].deltamsgs.sort(key=lambda i: i.ticks)
+    for i in range(len(song.tracks[0])):
+        song.tracks[0].redelta(i)
+    return song
+
+def synth_song(
+    seed,
+    tracks=4,
+    notes=2000,
+    density=4,
+    polyphony=4,
+    tempo_changes=0,
+    sysex=0,
+    sysex_size=16,
+    running_status=False,
+    ticks_per_quarter=480,
+):
+    '''Deterministic synthetic MIDI file bytes.
+    Track 0 holds a time signature, tempo_changes tempo msgs and sysex SysEx msgs of sysex_size data bytes. Each other track holds notes notes on its own channel.
+    density is note starts per quarter note, and polyphony is about how many notes of a track sound at once.'''
+    rng = random.Random(seed)
+    song = midi.Song(ticks_per_quarter=ticks_per_quarter, track_count=tracks)
+    gap = ticks_per_quarter / density
+    length = int(notes * gap) + ticks_per_quarter
+    conductor = [(midi.Msg(0xff, 0x58, 4, 4, 2, 24, 8), 0), (midi.Msg.tempo(500000), 0)]
+    for i in range(tempo_changes):
+        conductor.append((midi.Msg.tempo(rng.randrange(300000, 1000000)), rng.randrange(length)))
+    for i in range(sysex):
+        data = [rng.randrange(0x80) for j in range(sysex_size)]
+        conductor.append((midi.Msg(0xf0, *midi_vlq(len(data) + 1), *data, 0xf7), rng.randrange(length)))
+    song.tracks[0].add_many(conductor)
+    for track_index in range(1, tracks):
+        ticks = 0
+        track_notes = []
+        for i in range(notes):
+            ticks += int(rng.expovariate(1 / gap))
+            duration = max(1, int(rng.uniform(0.5, 1.5) * gap * polyphony))
+            track_notes.append((ticks, duration, rng.randrange(36, 96), rng.randrange(20, 128)))
+        song.add_notes(track_index, track_notes, (track_index - 1) % 16)
+    return song.save_bytes(running_status)
+
+def midi_vlq(value):
+    'The bytes of a MIDI variable-length quantity.'
+    result = [value & 0x7f]
+    value >>= 7
+    while value:
+        result.insert(0, 0x80 | value & 0x7f)
+        value >>= 7
+    return result
+
+# (name, synth_song kwargs)
+synth_corpus = [
+    ('sparse', {'tracks': 2, 'notes': 2000, 'density': 1, 'polyphony': 1}),
+    ('dense piano', {'tracks': 2, 'notes': 20000, 'density': 16, 'polyphony': 10}),
+    ('many tracks', {'tracks': 17, 'notes': 2000, 'density': 4, 'polyphony': 3}),
+    ('tempo changes', {'tracks': 4, 'notes': 5000, 'tempo_changes': 2000}),
+    ('sysex heavy', {'tracks': 4, 'notes': 2000, 'sysex': 1000, 'sysex_size': 256}),
+    ('running status', {'tracks': 4, 'notes': 5000, 'polyphony': 6, 'running_status': True}),
+]
+
+def legacy_pair_notes(song, track_index):
+    'The note pairing Song.load did before pair_notes, kept for comparison.'
+    track = song.tracks[track_index]
+    for i, v in enumerate(track):
+        if not v.is_note_start(): continue
+        for j, u in enumerate(track[i+1:]):
+            if u.is_note_end() and u.note() == v.note():
+                v.set_note_end(midi.Ref(song, track_index, i+1+j))
+                break
+
+def legacy_load(file_bytes):
+    'The per-byte track decoding Song.load did before CompactTrack.parse, kept for comparison.'
+    song = midi.Song(track_count=0)
+    index = 14
+    while index < len(file_bytes):
+        size = int.from_bytes(file_bytes[index+4:index+8], 'big')
+        chunk = file_bytes[index:index+8+size]
+        index += 8 + size
+        track = midi.Track()
+        i = 8
+        running_status = None
+        while i < len(chunk):
+            delta = 0
+            for j in range(i, i+4):
+                delta <<= 7
+                delta += chunk[j] & 0x7f
+                if not chunk[j] & 0x80: break
+            i = j+1
+            if chunk[i] & 0x80:
+                status = chunk[i]
+                if chunk[i] & 0xf0 != 0xf0:
+                    running_status = status
+                i += 1
+            else:
+                status = running_status
+            if status & 0xf0 in [0x80, 0x90, 0xa0, 0xb0, 0xe0]:
+                data = chunk[i:i+2]
+                i += 2
+            elif status & 0xf0 in [0xc0, 0xd0]:
+                data = chunk[i:i+1]
+                i += 1
+            else:
+                data_size = 2 + chunk[i+1]
+                data = chunk[i:i+data_size]
+                i += data_size
+            track.append(midi.Deltamsg(delta, bytes([status]) + data))
+        song.tracks.append(track)
+        legacy_pair_notes(song, len(song.tracks) - 1)
+    return song
+
+def legacy_save_bytes(song):
+    'The list-of-ints serialization Song.save did before write_track, kept for comparison.'
+    result = b'MThd' + bytes([0, 0, 0, 6, 0, 1]) + len(song.tracks).to_bytes(2, 'big') + song.ticks_per_quarter.to_bytes(2, 'big')
+    for track in song.tracks:
+        track_bytes = []
+        for deltamsg in track:
+            track_bytes.extend(deltamsg.delta_bytes())
+            track_bytes.extend(deltamsg.msg_bytes())
+        if track_bytes[-4:] != [0x01, 0xff, 0x2f, 0x00]:
+            track_bytes += [0x01, 0xff, 0x2f, 0x00]
+        result += b'MTrk' + len(track_bytes).to_bytes(4, 'big') + bytes(track_bytes)
+    return result
+
+def legacy_interleave(*tracks):
+    'The TrackIter stepping interleave did before merge, kept for comparison.'
+    result = midi.Track()
+    iters = [midi.TrackIter(i) for i in tracks]
+    while not all(i.stopped() for i in iters):
+        delta = min(i.delta() for i in iters)
+        first = True
+        for j in [i.advance(delta, True) for i in iters]:
+            if deltamsg := j:
+                if first:
+                    first = False
+                    result.append(deltamsg)
+                else:
+                    result.append(midi.Deltamsg(0, deltamsg.bytes))
+    return result
+
+class LegacyMsg:
+    'Msg as it was before __slots__ and lookup tables, kept for comparison.'
+
+    def __init__(self, *bytes_):
+        self.bytes = bytes_
+
+    def __eq__(self, other):
+        return self.bytes == other.bytes
+
+    def status(self):
+        return self.bytes[0]
+
+    def type_nibble(self):
+        return self.status() & 0xf0
+
+    def controller(self):
+        return self.bytes[1]
+
+    def is_note_start(self):
+        return self.type_nibble() == 0x90 and self.bytes[2] != 0
+
+    def is_control_change(self):
+        return self.type_nibble() == 0xb0
+
+    def is_meta(self):
+        return self.status() == 0xff
+
+    def is_sysex(self):
+        return self.status() in [0xf0, 0xf7]
+
+    def meta_type(self):
+        return self.bytes[1]
+
+    def type(self):
+        if self.is_meta():
+            return {
+                0x00: 'sequence_number',
+                0x01: 'text',
+                0x02: 'copyright',
+                0x03: 'track_name',
+                0x04: 'instrument_name',
+                0x05: 'lyric',
+                0x06: 'marker',
+                0x07: 'cue',
+                0x20: 'channel_prefix',
+                0x21: 'midi_port',
+                0x2f: 'end_of_track',
+                0x51: 'tempo',
+                0x54: 'smpte_offset',
+                0x58: 'time_sig',
+                0x59: 'key_sig',
+                0x7f: 'sequencer_specific',
+            }.get(self.meta_type(), 'unknown')
+        elif self.is_control_change():
+            return 'control_change ' + {
+                0x00: 'bank_select',
+                0x01: 'mod_wheel',
+                0x02: 'breath_control',
+                0x04: 'foot_controller',
+                0x06: 'data (RPN/NRPN)',
+                0x07: 'volume',
+                0x0a: 'pan',
+                0x0b: 'expression',
+                0x40: 'damper_pedal',
+                0x41: 'portamento',
+                0x47: 'resonance',
+                0x4a: 'cutoff_frequency',
+                0x5b: 'reverb',
+                0x5c: 'tremolo',
+                0x5d: 'chorus',
+                0x5e: 'detune',
+                0x5f: 'phaser',
+                0x79: 'reset',
+            }.get(self.controller(), 'unknown')
+        elif self.is_sysex():
+            return 'sysex'
+        return {
+            0x80: 'note_off',
+            0x90: 'note_on',
+            0xa0: 'polyphonic_key_pressure',
+            0xc0: 'program_change',
+            0xd0: 'channel_pressure',
+            0xe0: 'pitch_wheel_change',
+            0xf0: 'system',
+        }[self.type_nibble()]
+
+class LegacyDeltamsg(LegacyMsg):
+    'Deltamsg as it was before __slots__, kept for comparison.'
+
+    def __init__(self, delta, bytes_, ticks=None, note_end=None):
+        self.delta = delta
+        LegacyMsg.__init__(self, *bytes_)
+        self.ticks = ticks
+        self.note_end = note_end
+
+def smf(*tracks, format=1, ticks_per_quarter=360):
+    'A MIDI file from raw track chunk data.'
+    result = b'MThd' + bytes([0, 0, 0, 6, 0, format]) + len(tracks).to_bytes(2, 'big') + ticks_per_quarter.to_bytes(2, 'big')
+    for track in tracks:
+        result += b'MTrk' + len(track).to_bytes(4, 'big') + track
+    return result
+
+eot = bytes([0x00, 0xff, 0x2f, 0x00])
+big_dump = bytes(range(0x80)) * 300
+
+# (name, file bytes, load kwargs, expected msgs of the last track as (ticks, bytes))
+regression_corpus = [
+    (
+        'sysex with one-byte size',
+        smf(bytes([0x00, 0xf0, 0x05, 0x7e, 0x7f, 0x09, 0x01, 0xf7]) + eot),
+        {},
+        [(0, (0xf0, 0x05, 0x7e, 0x7f, 0x09, 0x01, 0xf7)), (0, (0xff, 0x2f, 0x00))],
+    ),
+    (
+        'sysex with multi-byte size',
+        smf(bytes([0x10, 0xf0, 0x82, 0xac, 0x00]) + big_dump + eot),
+        {},
+        [(0x10, (0xf0, 0x82, 0xac, 0x00, *big_dump)), (0x10, (0xff, 0x2f, 0x00))],
+    ),
+    (
+        'sysex skipped, keeping its delta',
+        smf(bytes([0x10, 0xf0, 0x82, 0xac, 0x00]) + big_dump + bytes([0x05, 0x90, 0x3c, 0x40]) + eot),
+        {'sysex': False},
+        [(0x15, (0x90, 0x3c, 0x40)), (0x15, (0xff, 0x2f, 0x00))],
+    ),
+    (
+        'escape sysex',
+        smf(bytes([0x00, 0xf0, 0x02, 0x43, 0x12, 0x04, 0xf7, 0x02, 0x00, 0xf7]) + eot),
+        {},
+        [(0, (0xf0, 0x02, 0x43, 0x12)), (4, (0xf7, 0x02, 0x00, 0xf7)), (4, (0xff, 0x2f, 0x00))],
+    ),
+    (
+        'running status through sysex and meta',
+        smf(bytes([0x00, 0x90, 0x3c, 0x40, 0x00, 0xf0, 0x01, 0xf7, 0x00, 0xff, 0x01, 0x01, 0x61, 0x01, 0x3c, 0x00]) + eot),
+        {},
+        [(0, (0x90, 0x3c, 0x40)), (0, (0xf0, 0x01, 0xf7)), (0, (0xff, 0x01, 0x01, 0x61)), (1, (0x90, 0x3c, 0x00)), (1, (0xff, 0x2f, 0x00))],
+    ),
+    (
+        'meta with multi-byte size',
+        smf(bytes([0x00, 0xff, 0x01, 0x81, 0x00]) + b'a' * 0x80 + eot),
+        {},
+        [(0, (0xff, 0x01, 0x81, 0x00, *b'a' * 0x80)), (0, (0xff, 0x2f, 0x00))],
+    ),
+    (
+        'text meta skipped, tempo kept',
+        smf(bytes([0x00, 0xff, 0x01, 0x81, 0x00]) + b'a' * 0x80 + bytes([0x00, 0xff, 0x51, 0x03, 0x07, 0xa1, 0x20]) + eot),
+        {'meta': False},
+        [(0, (0xff, 0x51, 0x03, 0x07, 0xa1, 0x20)), (0, (0xff, 0x2f, 0x00))],
+    ),
+    (
+        'unknown meta type',
+        smf(bytes([0x00, 0xff, 0x60, 0x02, 0x01, 0x02]) + eot),
+        {},
+        [(0, (0xff, 0x60, 0x02, 0x01, 0x02)), (0, (0xff, 0x2f, 0x00))],
+    ),
+]
+
+def check_regression_corpus():
+    for name, file_bytes, kwargs, expected in regression_corpus:
+        for compact in [False, True]:
+            song = midi.Song(file_bytes=file_bytes, compact=compact, **kwargs)
+            actual = [(i.ticks, tuple(i.bytes)) for i in song[-1]]
+            if actual != expected:
+                raise Exception(f'{name}: expected {expected}, got {actual}')
+            if [(i.ticks, tuple(i.bytes)) for i in midi.Song(file_bytes=song.save_bytes())[-1]] != expected:
+                raise Exception(f'{name}: changed by saving')
+    print(f'regression corpus: {len(regression_corpus)} files ok')
+
+def check_player():
+    'Drive a Player with a fake clock through a tempo change, a loop and a seek, checking what reaches a RecordingSink and when.'
+    song = midi.Song()
+    song.tracks[0].add(midi.Msg.tempo(250000), 720)
+    for ticks in [0, 360, 720, 1080]:
+        song.add_note(1, ticks, 180, 0x3c)
+    song.tracks[1].add(midi.Msg(0xf0, 0x02, 0x43, 0x12), 0)
+    song.tracks[1].add(midi.Msg(0xf7, 0x02, 0x00, 0xf7), 0)
+    now = [0.0]
+    clock = lambda: now[0]
+    def play(limit=None, seek=None, loop=None):
+        player = midi.Player(song, midi.RecordingSink(clock), clock=clock)
+        if seek != None: player.seek(seek)
+        if loop != None: player.loop(*loop)
+        start = now[0]
+        for wait in player.steps():
+            now[0] += wait
+            if limit != None and len(player.sink.records) >= limit: player.stopping.set()
+        if any(abs(dispatched - deadline) > 1e-9 for dispatched, deadline, msg_bytes in player.sink.records):
+            raise Exception('player: msgs dispatched off their deadlines')
+        return [(round(deadline - start, 9), msg_bytes) for dispatched, deadline, msg_bytes in player.sink.records]
+    on, off = bytes([0x90, 0x3c, 0x40]), bytes([0x80, 0x3c, 0x40])
+    # the tempo doubles at ticks 720, so the last two notes are half as long
+    expected = [
+        (0, on), (0, bytes([0xf0, 0x43, 0x12])), (0, bytes([0x00, 0xf7])), (0.25, off),
+        (0.5, on), (0.75, off), (1, on), (1.125, off), (1.25, on), (1.375, off),
+    ]
+    actual = play()
+    if sorted(actual) != sorted(expected):
+        raise Exception(f'player: expected {expected}, got {actual}')
+    # after ticks 900, the loop jumps from ticks 1080, at 1.25 s, back to ticks 360
+    actual = play(limit=10, loop=(360, 1080))
+    if actual[8:] != [(1.25, on), (1.5, off)]:
+        raise Exception(f'player: loop went wrong, got {actual}')
+    actual = play(seek=720)
+    if actual != [(0, on), (0.125, off), (0.25, on), (0.375, off)]:
+        raise Exception(f'player: seek went wrong, got {actual}')
+    print('player: tempo change, loop and seek ok')
+
+def check_capture(notes=2000):
+    'Feed a Capture from a producer thread while draining it, and check overflow, oversized and ignored counts, note pairing and the end of track.'
+    song = midi.Song()
+    song.add_note(1, 0, 60, 0x30)
+    song = midi.Song(file_bytes=song.save_bytes())
+    capture = midi.Capture(song, 1, capacity=64, clock=lambda: notes * 0.01 + 1, start=0)
+    def produce():
+        for k in range(notes):
+            # one msg over msg_size, put once since it never fits, then one that can't go in a file and one cut short; the rest are retried while the buffer is full
+            msgs = [((0x90, 0x3c + k % 12, 0x40), k * 0.01), ((0x80, 0x3c + k % 12, 0x40), k * 0.01 + 0.005)]
+            if k == notes // 2:
+                capture.put(bytes([0xf0, 0x7e, 0x09, 0x01, 0xf7]), k * 0.01)
+                msgs[:0] = [((0xf8,), k * 0.01), ((0x90,), k * 0.01)]
+            for bytes_, timestamp in msgs:
+                while not capture.put(bytes(bytes_), timestamp): time.sleep(0)
+    producer = threading.Thread(target=produce)
+    producer.start()
+    while producer.is_alive() or capture.written > capture.read:
+        capture.drain(16)
+    producer.join()
+    track = capture.finish()
+    stats = capture.stats()
+    if (stats['drained'], stats['oversized'], stats['ignored'], stats['waiting']) != (2 * notes + 2, 1, 2, 0):
+        raise Exception(f'capture: unexpected stats {stats}')
+    # a full buffer drops msgs and counts them, without blocking
+    for k in range(capture.capacity + 5): capture.put(bytes([0x90, 0x3c, 0x40]), 0)
+    if capture.overflows - stats['overflows'] != 5:
+        raise Exception(f'capture: expected 5 more overflows, got {capture.overflows - stats["overflows"]}')
+    ends = [i for i, bytes_ in enumerate(track.msgs()) if bytes_ == (0xff, 0x2f, 0x00)]
+    if ends != [len(track) - 1]:
+        raise Exception(f'capture: end of track msgs at {ends} of {len(track)}')
+    reloaded = midi.Song(file_bytes=song.save_bytes())
+    if list(track.notes()) != list(reloaded[1].notes()) or len(list(track.notes())) != notes + 1:
+        raise Exception('capture: notes paired differently than when reloaded')
+    print(f'capture: {notes} notes from a producer thread ok')
+
+def check_segments(trials=200, edits=30):
+    'Add and remove random notes, duplicates included, through Segments, and check it against a rebuild from the same notes after every edit.'
+    rng = random.Random(1)
+    for trial in range(trials):
+        notes = []
+        ticks = 0
+        # few distinct starts, pitches, lengths and channels, so notes that differ only by end or channel, and exact duplicates, come up
+        for i in range(rng.randrange(40)):
+            ticks += rng.choice([0, 0, 10, 50, 300])
+            notes.append((ticks, ticks + rng.choice([0, 20, 100, 200]), rng.randrange(58, 62), 0x40, rng.randrange(2)))
+        segments = midi.Segments(notes, rng.choice([0, 20, 100]), rng.choice([0, 5, 30]))
+        for edit in range(edits):
+            if notes and rng.random() < 0.5:
+                start, end, num, vel, channel = notes.pop(rng.randrange(len(notes)))
+                segments.remove(start, end, num, channel)
+            else:
+                start = rng.randrange(ticks + 500)
+                note = (start, start + rng.choice([0, 20, 100, 200]), rng.randrange(58, 62), 0x40, rng.randrange(2))
+                notes.append(note)
+                segments.add(note[0], note[1], note[2], note[4])
+            rebuilt = midi.Segments(notes, segments.min_rest, segments.tolerance)
+            for name in ['starts', 'ends', 'pitches', 'channels', 'phrase_starts', 'phrase_ends', 'chord_starts']:
+                if getattr(segments, name) != getattr(rebuilt, name):
+                    raise Exception(f'segments: {name} differ from a rebuild after {edit + 1} edits of trial {trial}')
+    print(f'segments: {trials * edits} edits match rebuilds')
+
+def shared_song_summary(name):
+    with midi.SharedSong.attach(name) as shared:
+        return song_summary(shared.song)
+
+def shared_song_scenario():
+    'Publish a song, attach to it from workers of each start method, republish it, and leave one publisher to garbage collection.'
+    song = midi.Song(file_bytes=synth_song(0, tempo_changes=20))
+    expected = song_summary(song)
+    with midi.SharedSong.publish(song) as shared:
+        for method in multiprocessing.get_all_start_methods():
+            with multiprocessing.get_context(method).Pool(2) as pool:
+                if pool.map(shared_song_summary, [shared.name] * 2) != [expected] * 2:
+                    raise Exception(f'shared song: {method} workers saw a different song')
+        with midi.SharedSong.publish(shared.song) as republished:
+            if song_summary(republished.song) != expected:
+                raise Exception('shared song: changed by republishing')
+    midi.SharedSong.publish(song)
+
+def check_shared_song():
+    '''Run shared_song_scenario in a fresh interpreter, which its resource tracker outlives, and check nothing went to stderr.
+    A worker that unregisters the publisher's memory from a shared tracker shows up as a KeyError there, and views left unreleased as a BufferError.'''
+    result = subprocess.run(
+        [sys.executable, '-c', 'import bench; bench.shared_song_scenario()'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True,
+    )
+    errors = [line for line in result.stderr.splitlines() if 'Error' in line or 'leaked' in line]
+    if result.returncode or errors:
+        raise Exception(f'shared song: {result.stderr}')
+    print(f'shared song: attached from {", ".join(multiprocessing.get_all_start_methods())} workers ok')
+
+def check_loaders(file_bytes, name):
+    'Check that Track and CompactTrack loading both agree with legacy_load.'
+    legacy = song_summary(legacy_load(file_bytes))
+    for compact in [False, True]:
+        # legacy pairing gives every open start the first note end, which only matches fifo when notes of a key don't overlap
+        if song_summary(midi.Song(file_bytes=file_bytes, overlap='all', compact=compact)) != legacy:
+            raise Exception(f'{name}: loaders disagree')
+
+def check_synth_corpus(corpus=synth_corpus):
+    'Check the loaders against legacy_load on the synthetic corpus, leaving out songs with SysEx, which legacy_load reads as meta.'
+    checked = [name for name, kwargs in corpus if not kwargs.get('sysex')]
+    for name, kwargs in corpus:
+        if name in checked: check_loaders(synth_song(0, **kwargs), name)
+    print(f'synthetic corpus: {len(checked)} songs load as legacy_load did')
+
+def song_summary(song):
+    'Everything loading decides about a song, for checking loaders against each other.'
+    return [
+        [
+            (i.delta, i.ticks, tuple(i.bytes), i.note_end and i.note_end().ticks)
+            for i in track
+        ]
+        for track in song
+    ]
+
+def timed(f, *args):
+    start = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - start
+
+def memory_per_event(make, events):
+    'Bytes traced while making events deltamsgs with make(delta, bytes, ticks), per deltamsg.'
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    deltamsgs = [make(1, list(bytes_), i) for i, bytes_ in enumerate(events)]
+    result = (tracemalloc.get_traced_memory()[0] - start) / len(deltamsgs)
+    tracemalloc.stop()
+    return result
+
+def bench_msgs(file_path, repeat=5):
+    'Memory per event and per call cost of msg methods, against the unslotted msgs they replaced.'
+    events = [tuple(deltamsg.bytes) for track in midi.Song(file_path) for deltamsg in track]
+    legacy = memory_per_event(LegacyDeltamsg, events)
+    slotted = memory_per_event(midi.Deltamsg, events)
+    print(f'msgs {len(events)} events: legacy {legacy:6.1f} B/event, slotted {slotted:6.1f} B/event ({legacy/slotted:4.1f}x)')
+    legacy_msgs = [LegacyDeltamsg(0, i) for i in events]
+    msgs = [midi.Deltamsg(0, i) for i in events]
+    for name, call in [
+        ('is_note_start', lambda msgs: [i.is_note_start() for i in msgs]),
+        ('type', lambda msgs: [i.type() for i in msgs]),
+        ('__eq__', lambda msgs: [i == i for i in msgs]),
+    ]:
+        legacy = min(timed(call, legacy_msgs) for i in range(repeat)) / len(events) * 1e9
+        slotted = min(timed(call, msgs) for i in range(repeat)) / len(events) * 1e9
+        print(f'  {name:<13}: legacy {legacy:6.1f} ns/call, slotted {slotted:6.1f} ns/call ({legacy/slotted:4.1f}x)')
+    with open(file_path, 'rb') as file: file_bytes = file.read()
+    legacy = timed(lambda: legacy_save_bytes(legacy_load(file_bytes)))
+    round_trip = timed(lambda: midi.Song(file_bytes=file_bytes).save_bytes())
+    print(f'  load and save: legacy {legacy/len(events)*1e6:6.2f} us/event, now {round_trip/len(events)*1e6:6.2f} us/event ({legacy/round_trip:4.1f}x)')
+
+def measure(setup, op, repeat=3):
+    '''Best time of op(setup()) over repeat runs, not counting setup, and the peak memory traced during one more run.'''
+    seconds = min(timed(op, setup()) for i in range(repeat))
+    state = setup()
+    tracemalloc.start()
+    op(state)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+def suite_ops(file_bytes):
+    'The operations run by bench_suite on one file, as (name, setup, op).'
+    load = lambda: midi.Song(file_bytes=file_bytes)
+    def select(song):
+        ticks_end = max(track[-1].ticks for track in song)
+        song.select(0, len(song), ticks_end // 4, ticks_end * 3 // 4)
+    def edit(song):
+        rng = random.Random(0)
+        ticks_end = song[1][-1].ticks
+        song.add_notes(1, [(rng.randrange(ticks_end), rng.randrange(1, 480), rng.randrange(36, 96)) for i in range(1000)])
+        song.transpose(2)
+    def pair_notes(song):
+        for track_index in range(len(song)):
+            song.pair_notes(track_index)
+    return [
+        ('load', lambda: file_bytes, lambda file_bytes: midi.Song(file_bytes=file_bytes)),
+        ('load compact', lambda: file_bytes, lambda file_bytes: midi.Song(file_bytes=file_bytes, compact=True)),
+        ('save', load, lambda song: song.save_bytes()),
+        ('iterate', load, lambda song: [deltamsg.is_note_start() for track in song for deltamsg in track]),
+        ('merge', load, lambda song: midi.interleave(*song)),
+        ('select', load, select),
+        ('edit', load, edit),
+        ('pair notes', load, pair_notes),
+    ]
+
+def bench_suite(corpus=synth_corpus):
+    'Time each suite operation on each synthetic song. Returns a list of result dicts, one per song and operation.'
+    results = []
+    for name, kwargs in corpus:
+        file_bytes = synth_song(0, **kwargs)
+        events = sum(len(track) for track in midi.Song(file_bytes=file_bytes))
+        for op_name, setup, op in suite_ops(file_bytes):
+            seconds, peak = measure(setup, op)
+            results.append({
+                'corpus': name,
+                'params': kwargs,
+                'op': op_name,
+                'bytes': len(file_bytes),
+                'events': events,
+                'seconds': seconds,
+                'events_per_second': events / seconds,
+                'peak_bytes': peak,
+            })
+            print(f'{name:<15} {op_name:<13} {events:>7} events: {seconds:8.4f} s, {events/seconds/1e6:6.3f} M events/s, peak {peak/1e6:8.2f} MB')
+    return results
+
+def bench_pair_notes():
+    for notes in [1000, 5000, 20000]:
+        song = synth_track(0, notes)
+        legacy = timed(legacy_pair_notes, song, 0)
+        fifo = timed(song.pair_notes, 0, 'fifo')
+        print(f'pair_notes {2*notes:>6} events: legacy {legacy:8.3f} s, fifo {fifo:8.3f} s, {legacy/fifo:6.1f}x')
+
+def bench_load(file_path):
+    with open(file_path, 'rb') as file: file_bytes = file.read()
+    legacy = timed(legacy_load, file_bytes)
+    track = timed(midi.Song, None, file_bytes)
+    compact = timed(midi.Song, None, file_bytes, 360, 2, 'fifo', True)
+    check_loaders(file_bytes, file_path)
+    print(f'load {len(file_bytes):>9} bytes: legacy {legacy:8.3f} s, Track {track:8.3f} s ({legacy/track:5.1f}x), CompactTrack {compact:8.3f} s ({legacy/compact:5.1f}x)')
+
+def bench_save(file_path):
+    song = midi.Song(file_path)
+    legacy = timed(legacy_save_bytes, song)
+    save = timed(song.save_bytes)
+    running_status = timed(song.save_bytes, True)
+    print(f'save {file_path}: legacy {legacy:8.3f} s, save_bytes {save:8.3f} s ({legacy/save:5.1f}x), with running status {running_status:8.3f} s')
+
+def bench_interleave(file_path):
+    song = midi.Song(file_path)
+    legacy = timed(legacy_interleave, *song)
+    merge = timed(midi.interleave, *song)
+    if song_summary([legacy_interleave(*song)]) != song_summary([midi.interleave(*song)]):
+        raise Exception('interleaves disagree')
+    print(f'interleave {len(song)} tracks: legacy {legacy:8.3f} s, merge {merge:8.3f} s ({legacy/merge:5.1f}x)')
+
+def bench_add_notes(file_path, notes=20000):
+    rng = random.Random(0)
+    notes = [(rng.randrange(200000), rng.randrange(1, 300), rng.randrange(40, 80)) for i in range(notes)]
+    song = midi.Song(file_path)
+    def add_note():
+        for note in notes:
+            song.add_note(1, *note)
+    one = timed(add_note)
+    batch = timed(midi.Song(file_path).add_notes, 1, notes)
+    print(f'add {len(notes)} notes: add_note {one:8.3f} s, add_notes {batch:8.3f} s ({one/batch:5.1f}x)')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark midi.py.')
+    parser.add_argument('files', nargs='*', help='MIDI files to benchmark against legacy implementations')
+    parser.add_argument('--json', help='write suite results to this path, to compare runs over time')
+    args = parser.parse_args()
+    check_regression_corpus()
+    check_synth_corpus()
+    check_player()
+    check_capture()
+    check_segments()
+    check_shared_song()
+    results = bench_suite()
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({
+                'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                'python': sys.version,
+                'platform': platform.platform(),
+                'results': results,
+            }, file, indent=2)
+    bench_pair_notes()
+    for file_path in args.files:
+        bench_load(file_path)
+        bench_save(file_path)
+        bench_interleave(file_path)
+        bench_add_notes(file_path)
+        bench_msgs(file_path)
@@ -1,7 +1,95 @@
+import array
+import asyncio
 import bisect
+import collections
+import collections.abc
+import concurrent.futures
+import contextlib
+import hashlib
+import heapq
+import itertools
+import json
 import math
+import mmap
+import multiprocessing.resource_tracker
+import multiprocessing.shared_memory
+import numbers
+import os
+import sqlite3
+import statistics
+import sys
+import threading
+import time
+import weakref
 
 class Msg:
+    '''A MIDI msg. bytes is a tuple starting with the status byte.
+    Msgs have __slots__ and no __dict__, since songs hold one per event.'''
+
+    __slots__ = ['bytes']
+
+    meta_types = {
+        0x00: 'sequence_number',
+        0x01: 'text',
+        0x02: 'copyright',
+        0x03: 'track_name',
+        0x04: 'instrument_name',
+        0x05: 'lyric',
+        0x06: 'marker',
+        0x07: 'cue',
+        0x20: 'channel_prefix',
+        0x21: 'midi_port',
+        0x2f: 'end_of_track',
+        0x51: 'tempo',
+        0x54: 'smpte_offset',
+        0x58: 'time_sig',
+        0x59: 'key_sig',
+        0x7f: 'sequencer_specific',
+    }
+
+    controller_types = {
+        0x00: 'bank_select',
+        0x01: 'mod_wheel',
+        0x02: 'breath_control',
+        0x04: 'foot_controller',
+        0x06: 'data (RPN/NRPN)',
+        0x07: 'volume',
+        0x0a: 'pan',
+        0x0b: 'expression',
+        0x40: 'damper_pedal',
+        0x41: 'portamento',
+        0x47: 'resonance',
+        0x4a: 'cutoff_frequency',
+        0x5b: 'reverb',
+        0x5c: 'tremolo',
+        0x5d: 'chorus',
+        0x5e: 'detune',
+        0x5f: 'phaser',
+        0x79: 'reset',
+    }
+
+    # lookup tables built once, so type() is a dict or tuple lookup
+    control_change_types = tuple('control_change ' + name for name in map(controller_types.get, range(0x100), ['unknown'] * 0x100))
+
+    status_types = {
+        status: {
+            0x80: 'note_off',
+            0x90: 'note_on',
+            0xa0: 'polyphonic_key_pressure',
+            0xc0: 'program_change',
+            0xd0: 'channel_pressure',
+            0xe0: 'pitch_wheel_change',
+            0xf0: 'sysex' if status in [0xf0, 0xf7] else 'system',
+        }.get(status & 0xf0)
+        for status in range(0x80, 0x100)
+    }
+
+    # the length of a channel msg by status byte, or None for system msgs, whose length is in their data
+    status_lengths = tuple(
+        None if status >= 0xf0 else 2 if 0xc0 <= status < 0xe0 else 3
+        for status in range(0x100)
+    )
+
     def note_on(num, vel=0x40, channel=0):
         assert 0 <= num <= 0xff
         assert 0 <= vel <= 0xff
@@ -16,7 +104,7 @@ class Msg:
 
     def tempo(us_per_quarter):
         assert 0 <= us_per_quarter <= 1 << 24
-        return Msg(0xff, 0x51, 3, us_per_quarter.to_bytes(3, 'big'))
+        return Msg(0xff, 0x51, 3, *us_per_quarter.to_bytes(3, 'big'))
 
     def pitch_bend_range(semitones=2, cents=0, channel=0):
         assert 0 <= semitones <= 0xff
@@ -33,6 +121,7 @@ class Msg:
         self.bytes = bytes_
 
     def __eq__(self, other):
+        if not isinstance(other, Msg): return NotImplemented
         return self.bytes == other.bytes
 
     def __iter__(self):
@@ -61,39 +150,40 @@ class Msg:
         return self.bytes[0]
 
     def type_nibble(self):
-        return self.status() & 0xf0
+        return self.bytes[0] & 0xf0
 
     def channel(self):
-        if self.type_nibble() == 0xf0:
+        if self.bytes[0] >= 0xf0:
             raise Exception("system messages don't have a channel")
-        return self.status() & 0x0f
+        return self.bytes[0] & 0x0f
 
     def vel(self):
         assert self.has_vel()
         return self.bytes[2]
 
     def has_vel(self):
-        return self.type_nibble() in [0x80, 0x90]
+        return 0x80 <= self.bytes[0] < 0xa0
 
     def note(self):
         assert self.has_note()
         return self.bytes[1]
 
     def has_note(self):
-        return self.type_nibble() in [0x80, 0x90, 0xa0]
+        return 0x80 <= self.bytes[0] < 0xb0
 
     def is_note_start(self):
         'Check if this msg is a note on with nonzero velocity.'
-        return self.type_nibble() == 0x90 and self.bytes[2] != 0
+        bytes_ = self.bytes
+        return 0x90 <= bytes_[0] < 0xa0 and bytes_[2] != 0
 
     def is_note_end(self):
         'Check if this msg is a note on with 0 velocity, or a note off.'
-        if self.type_nibble() == 0x80: return True
-        if self.type_nibble() == 0x90 and self.bytes[2] == 0: return True
-        return False
+        bytes_ = self.bytes
+        status = bytes_[0]
+        return 0x80 <= status < 0x90 or 0x90 <= status < 0xa0 and bytes_[2] == 0
 
     def is_note(self):
-        return self.type_nibble() in [0x80, 0x90]
+        return 0x80 <= self.bytes[0] < 0xa0
 
     def controller(self):
         assert self.is_control_change()
@@ -104,12 +194,15 @@ class Msg:
         return self.bytes[2]
 
     def is_control_change(self):
-        return self.type_nibble() == 0xb0
+        return 0xb0 <= self.bytes[0] < 0xc0
 
     def tempo_us_per_quarter(self):
         assert self.type() == 'tempo'
         return int.from_bytes(self.bytes[3:6], 'big')
 
+    def is_tempo(self):
+        return self.bytes[0] == 0xff and self.bytes[1] == 0x51
+
     def time_sig_top(self):
         assert self.type() == 'time_sig'
         return self.bytes[3]
@@ -129,78 +222,40 @@ class Msg:
         return self.bytes[4]
 
     def is_meta(self):
-        return self.status() == 0xff
+        return self.bytes[0] == 0xff
+
+    def is_sysex(self):
+        return self.status() in [0xf0, 0xf7]
 
     def meta_type(self):
         assert self.is_meta()
         return self.bytes[1]
 
     def type(self):
-        if self.is_meta():
-            return {
-                0x00: 'sequence_number',
-                0x01: 'text',
-                0x02: 'copyright',
-                0x03: 'track_name',
-                0x04: 'instrument_name',
-                0x05: 'lyric',
-                0x06: 'marker',
-                0x07: 'cue',
-                0x20: 'channel_prefix',
-                0x21: 'midi_port',
-                0x2f: 'end_of_track',
-                0x51: 'tempo',
-                0x54: 'smpte_offset',
-                0x58: 'time_sig',
-                0x59: 'key_sig',
-                0x7f: 'sequencer_specific',
-            }.get(self.meta_type(), 'unknown')
-        elif self.is_control_change():
-            return 'control_change ' + {
-                0x00: 'bank_select',
-                0x01: 'mod_wheel',
-                0x02: 'breath_control',
-                0x04: 'foot_controller',
-                0x06: 'data (RPN/NRPN)',
-                0x07: 'volume',
-                0x0a: 'pan',
-                0x0b: 'expression',
-                0x40: 'damper_pedal',
-                0x41: 'portamento',
-                0x47: 'resonance',
-                0x4a: 'cutoff_frequency',
-                0x5b: 'reverb',
-                0x5c: 'tremolo',
-                0x5d: 'chorus',
-                0x5e: 'detune',
-                0x5f: 'phaser',
-                0x79: 'reset',
-            }.get(self.controller(), 'unknown')
-        return {
-            0x80: 'note_off',
-            0x90: 'note_on',
-            0xa0: 'polyphonic_key_pressure',
-            0xc0: 'program_change',
-            0xd0: 'channel_pressure',
-            0xe0: 'pitch_wheel_change',
-            0xf0: 'system',
-        }[self.type_nibble()]
+        status = self.bytes[0]
+        if status == 0xff:
+            return Msg.meta_types.get(self.bytes[1], 'unknown')
+        if status & 0xf0 == 0xb0:
+            return Msg.control_change_types[self.bytes[1]]
+        return Msg.status_types[status]
 
     def transpose(self, semitones):
         assert self.has_note()
         assert 0 <= self.bytes[1] + semitones <= 0xff
-        self.bytes[1] += semitones
+        self.bytes = (self.bytes[0], self.bytes[1] + semitones, *self.bytes[2:])
 
     def set_vel(self, vel):
         assert self.has_vel()
         assert 0 <= vel <= 0xff
-        self.bytes[2] = vel
+        self.bytes = (*self.bytes[:2], vel, *self.bytes[3:])
 
 class Deltamsg(Msg):
+    __slots__ = ['delta', 'ticks', 'note_end']
+
     def __init__(self, delta, bytes_, ticks=None, note_end=None):
         'A note end could be a note on with 0 velocity or a note off.'
         self.delta = delta
-        Msg.__init__(self, *bytes_)
+        self.bytes = tuple(bytes_)
         self.ticks = ticks
         if note_end:
             self.set_note_end(note_end)
@@ -245,11 +300,21 @@ class Deltamsg(Msg):
         Msg.transpose(self, semitones)
         if self.note_end:
             self.note_end().transpose(semitones)
+            self.edited()
+
+    def set_vel(self, vel):
+        Msg.set_vel(self, vel)
+        if self.note_end: self.edited()
+
+    def edited(self):
+        'Count an edit of a paired note start on its track, so caches keyed on edits, like the NoteIndex, are rebuilt. The deltamsg doesn\'t know its track, but the Ref to its note end does.'
+        self.note_end.track().edits += 1
 
     def durate(self, ticks):
+        'Move the note end so the note lasts ticks.'
+        note_end = self.note_end()
         self.note_end.remove()
-        i = self.note_end.track().add(self.note_end(), self.ticks + ticks)
-        self.note_end().renorm(i)
+        self.note_end.renorm(self.note_end.track().add(note_end, self.ticks + ticks))
 
 class Track:
     def __init__(self, deltamsgs=None):
@@ -257,6 +322,8 @@ class Track:
             self.deltamsgs = deltamsgs
         else:
             self.deltamsgs = []
+        self.edits = 0
+        self.tempo_edits = 0
 
     def __getitem__(self, i):
         return self.deltamsgs[i]
@@ -271,6 +338,8 @@ class Track:
             else:
                 deltamsg.ticks = deltamsg.delta
         self.deltamsgs.append(deltamsg)
+        self.edits += 1
+        if deltamsg.is_tempo(): self.tempo_edits += 1
 
     def redelta(self, i):
         'Recalculate deltamsgs[i].delta assuming ticks are correct.'
@@ -282,22 +351,74 @@ class Track:
         deltamsg.delta = deltamsg.ticks - ticks
 
     def add(self, msg, ticks):
-        if not self.deltamsgs: self.append(Deltamsg(ticks, msg.bytes))
         deltamsg = Deltamsg(None, msg.bytes, ticks)
         key = lambda i: [i.ticks, *i.bytes]
         i = bisect.bisect(self.deltamsgs, key(deltamsg), key=key)
         self.deltamsgs.insert(i, deltamsg)
         self.redelta(i)
-        self.redelta(i+1)
+        if i + 1 < len(self): self.redelta(i+1)
+        self.edits += 1
+        if msg.is_tempo(): self.tempo_edits += 1
         return i
 
+    def add_many(self, msgs):
+        '''Add many (msg, ticks) at once. They are sorted once, and only msgs from the earliest of them on are touched.
+        A few msgs into a long track are each bisected and inserted, with deltas fixed around them. Otherwise the rest of the track is merged with them and its deltas recalculated in one pass, which is O(n + m log m) rather than a bisect and insert each.
+        Returns the new deltamsgs in the order given.'''
+        added = [Deltamsg(None, msg.bytes, ticks) for msg, ticks in msgs]
+        if not added: return added
+        key = lambda i: [i.ticks, *i.bytes]
+        ordered = sorted(added, key=key)
+        deltamsgs = self.deltamsgs
+        # msgs before the earliest added one don't move
+        i = bisect.bisect(deltamsgs, key(ordered[0]), key=key)
+        if len(ordered) * 64 < len(deltamsgs) - i:
+            # a few msgs into a long tail: insert each, then fix the deltas around them
+            # each goes at or after the one before, so positions found earlier stay put
+            positions = []
+            for deltamsg in ordered:
+                i = bisect.bisect(deltamsgs, key(deltamsg), i, key=key)
+                deltamsgs.insert(i, deltamsg)
+                positions.append(i)
+            for i in positions:
+                self.redelta(i)
+                if i + 1 < len(self): self.redelta(i+1)
+        else:
+            deltamsgs[i:] = heapq.merge(deltamsgs[i:], ordered, key=key)
+            ticks = deltamsgs[i-1].ticks if i else 0
+            for deltamsg in itertools.islice(deltamsgs, i, None):
+                deltamsg.delta = deltamsg.ticks - ticks
+                ticks = deltamsg.ticks
+        self.edits += 1
+        self.tempo_edits += sum(1 for i in added if i.is_tempo())
+        return added
+
+    def remove(self, i):
+        deltamsg = self.deltamsgs.pop(i)
+        if i < len(self): self.redelta(i)
+        self.edits += 1
+        if deltamsg.is_tempo(): self.tempo_edits += 1
+        return deltamsg
+
     def find(self, ticks, deltamsg_id=None):
+        'Find the first msg at or after ticks, or if deltamsg_id is given, the msg with that id at ticks. Returns an index, or None.'
         i = bisect.bisect_left(self.deltamsgs, ticks, key=lambda i: i.ticks)
-        if deltamsg_id != None:
-            while id(self[i]) != deltamsg_id:
-                i += 1
-                if i < 0: return
-        return i
+        if deltamsg_id == None: return i
+        while i < len(self) and self[i].ticks <= ticks:
+            if id(self[i]) == deltamsg_id: return i
+            i += 1
+
+    def notes(self):
+        'Yield (start ticks, end ticks, note, velocity, channel) for each paired note start.'
+        for deltamsg in self.deltamsgs:
+            if deltamsg.note_end:
+                yield (deltamsg.ticks, deltamsg.note_end().ticks, deltamsg.bytes[1], deltamsg.bytes[2], deltamsg.bytes[0] & 0x0f)
+
+    def tempo_changes(self):
+        'Yield (ticks, us_per_quarter) for each tempo msg.'
+        for deltamsg in self.deltamsgs:
+            if deltamsg.is_tempo():
+                yield (deltamsg.ticks, deltamsg.tempo_us_per_quarter())
 
     def filter(self, predicate):
         result = Track()
@@ -309,8 +430,23 @@ class Track:
                 delta = 0
         return result
 
+    def events(self):
+        'Yield (delta, bytes) for each msg, as consumed by write_track.'
+        for deltamsg in self.deltamsgs:
+            yield (deltamsg.delta, deltamsg.bytes)
+
+    def note_keys(self):
+        'Yield (index, is_start, (channel, note)) for each note start and note end, as consumed by pair_notes.'
+        for i, deltamsg in enumerate(self):
+            if deltamsg.is_note_start():
+                yield (i, True, (deltamsg.status() & 0x0f, deltamsg.note()))
+            elif deltamsg.is_note_end():
+                yield (i, False, (deltamsg.status() & 0x0f, deltamsg.note()))
+
     def split(self, ticks=1):
-        notes = set()
+        'Split into lists of deltamsgs wherever no note sounds for more than ticks. See Segments for splitting without copying.'
+        # count sounding notes by (channel, note), so notes on different channels don't collide and stray note ends are ignored
+        notes = collections.Counter()
         rest = 0
         result = [[]]
         for deltamsg in self:
@@ -321,18 +457,392 @@ class Track:
             if rest > ticks and result[-1]:
                 result.append([])
             if deltamsg.is_note_start():
-                notes.add(deltamsg.note())
+                notes[(deltamsg.status() & 0x0f, deltamsg.note())] += 1
             elif deltamsg.is_note_end():
-                notes.remove(deltamsg.note())
+                key = (deltamsg.status() & 0x0f, deltamsg.note())
+                if notes[key] > 1: notes[key] -= 1
+                else: notes.pop(key, None)
             result[-1].append(deltamsg)
         return result
 
+class CompactTrack:
+    """Track stored as parallel array columns instead of Deltamsg objects.
+    Indexing and iterating make Deltamsg views on demand; changing a view doesn't change the track.
+    Channel msgs live in status, data1 and data2. System msgs keep everything after the status byte in payload, sliced by payload_offsets, and payload_events lists which msgs those are.
+    note_ends holds the index of each note start's note end, or -1."""
+
+    column_names = ['ticks', 'status', 'data1', 'data2', 'note_ends', 'payload_events', 'payload_offsets', 'payload']
+
+    def __init__(self, deltamsgs=None):
+        self.ticks = array.array('q')
+        self.status = array.array('B')
+        self.data1 = array.array('B')
+        self.data2 = array.array('B')
+        self.note_ends = array.array('q')
+        self.payload_events = array.array('q')
+        self.payload_offsets = array.array('q', [0])
+        self.payload = bytearray()
+        self.song = None
+        self.track_index = None
+        self.edits = 0
+        self.tempo_edits = 0
+        if deltamsgs != None:
+            for deltamsg in deltamsgs:
+                self.append(deltamsg)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0: i += len(self)
+        if not 0 <= i < len(self): raise IndexError('track index out of range')
+        return self.view(i, self.msg(i))
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def __iter__(self):
+        for i, bytes_ in enumerate(self.msgs()):
+            yield self.view(i, bytes_)
+
+    def view(self, i, bytes_):
+        deltamsg = Deltamsg(self.delta(i), bytes_, self.ticks[i])
+        if self.note_ends[i] >= 0 and self.song != None:
+            deltamsg.note_end = Ref(self.song, self.track_index, self.note_ends[i])
+        return deltamsg
+
+    def delta(self, i):
+        if i == 0: return self.ticks[0]
+        return self.ticks[i] - self.ticks[i-1]
+
+    def msg(self, i):
+        'The bytes of msg i as a tuple.'
+        status = self.status[i]
+        if status >= 0xf0:
+            j = bisect.bisect_left(self.payload_events, i)
+            return (status, *self.payload[self.payload_offsets[j]:self.payload_offsets[j+1]])
+        if Msg.status_lengths[status] == 2:
+            return (status, self.data1[i])
+        return (status, self.data1[i], self.data2[i])
+
+    def msgs(self):
+        'Yield the bytes of each msg as a tuple.'
+        payload = self.payload
+        payload_offsets = self.payload_offsets
+        status_lengths = Msg.status_lengths
+        payload_i = 0
+        for status, data1, data2 in zip(self.status, self.data1, self.data2):
+            length = status_lengths[status]
+            if length == None:
+                yield (status, *payload[payload_offsets[payload_i]:payload_offsets[payload_i+1]])
+                payload_i += 1
+            elif length == 2:
+                yield (status, data1)
+            else:
+                yield (status, data1, data2)
+
+    def events(self):
+        'Yield (delta, bytes) for each msg, as consumed by write_track.'
+        ticks_last = 0
+        for ticks, bytes_ in zip(self.ticks, self.msgs()):
+            yield (ticks - ticks_last, bytes_)
+            ticks_last = ticks
+
+    def append(self, deltamsg, note_end=-1):
+        ticks = deltamsg.ticks
+        if ticks == None:
+            ticks = deltamsg.delta
+            if self.ticks: ticks += self.ticks[-1]
+        self.append_bytes(ticks, deltamsg.bytes, note_end)
+
+    def append_bytes(self, ticks, bytes_, note_end=-1):
+        status = bytes_[0]
+        self.edits += 1
+        self.ticks.append(ticks)
+        self.status.append(status)
+        self.note_ends.append(note_end)
+        if status >= 0xf0:
+            self.data1.append(0)
+            self.data2.append(0)
+            self.payload_events.append(len(self.ticks) - 1)
+            self.payload.extend(bytes_[1:])
+            self.payload_offsets.append(len(self.payload))
+            if status == 0xff and bytes_[1] == 0x51: self.tempo_edits += 1
+        else:
+            self.data1.append(bytes_[1])
+            self.data2.append(bytes_[2] if len(bytes_) > 2 else 0)
+
+    def pop(self):
+        'Remove the last msg, returning its bytes as a tuple. Note starts it ended are left without a note end.'
+        i = len(self) - 1
+        result = self.msg(i)
+        self.edits += 1
+        if result[0] >= 0xf0:
+            self.payload_events.pop()
+            self.payload_offsets.pop()
+            del self.payload[self.payload_offsets[-1]:]
+            if result[0] == 0xff and result[1] == 0x51: self.tempo_edits += 1
+        for column in [self.ticks, self.status, self.data1, self.data2, self.note_ends]:
+            column.pop()
+        if result[0] & 0xf0 in [0x80, 0x90]:
+            for j, note_end in enumerate(self.note_ends):
+                if note_end == i: self.note_ends[j] = -1
+        return result
+
+    def parse(buffer, start=0, end=None, sysex=True, meta=True):
+        '''Decode buffer[start:end], the data of a track chunk, straight into columns.
+        If sysex is false, SysEx msgs are skipped. If meta is false, meta msgs other than end of track, tempo, time signature and key signature are skipped.
+        Skipped msgs are stepped over by their length without being copied.'''
+        if end == None: end = len(buffer)
+        view = memoryview(buffer)
+        result = CompactTrack()
+        ticks_append = result.ticks.append
+        status_append = result.status.append
+        data1_append = result.data1.append
+        data2_append = result.data2.append
+        payload_events = result.payload_events
+        payload_offsets = result.payload_offsets
+        payload = result.payload
+        status_lengths = Msg.status_lengths
+        ticks = 0
+        running_status = None
+        i = start
+        while i < end:
+            # delta
+            byte = buffer[i]
+            i += 1
+            if byte & 0x80:
+                delta = byte & 0x7f
+                for _ in range(3):
+                    byte = buffer[i]
+                    i += 1
+                    delta = delta << 7 | byte & 0x7f
+                    if not byte & 0x80: break
+                else: raise Exception('delta too big')
+                ticks += delta
+            else:
+                ticks += byte
+            # msg - status
+            status = buffer[i]
+            if status & 0x80:
+                i += 1
+                if status < 0xf0:
+                    running_status = status
+            elif running_status == None:
+                raise Exception('no status')
+            else:
+                status = running_status
+            # msg - data
+            length = status_lengths[status]
+            if length != None:
+                data1_append(buffer[i])
+                data2_append(buffer[i+1] if length == 3 else 0)
+                i += length - 1
+            else:
+                data_end = system_msg_end(buffer, status, i)
+                if data_end > end: break
+                if (
+                    (status != 0xff and sysex)
+                    or
+                    (status == 0xff and (meta or buffer[i] in [0x2f, 0x51, 0x58, 0x59]))
+                ):
+                    payload_events.append(len(result.ticks))
+                    payload += view[i:data_end]
+                    payload_offsets.append(len(payload))
+                    data1_append(0)
+                    data2_append(0)
+                    ticks_append(ticks)
+                    status_append(status)
+                i = data_end
+                continue
+            ticks_append(ticks)
+            status_append(status)
+        view.release()
+        if i != end: raise Exception('msg overruns track')
+        result.note_ends = array.array('q', [-1]) * len(result.ticks)
+        return result
+
+    def notes(self):
+        'Yield (start ticks, end ticks, note, velocity, channel) for each paired note start.'
+        ticks = self.ticks
+        for i, j in enumerate(self.note_ends):
+            if j >= 0:
+                yield (ticks[i], ticks[j], self.data1[i], self.data2[i], self.status[i] & 0x0f)
+
+    def tempo_changes(self):
+        'Yield (ticks, us_per_quarter) for each tempo msg.'
+        for j, i in enumerate(self.payload_events):
+            offset = self.payload_offsets[j]
+            if self.status[i] == 0xff and self.payload[offset] == 0x51:
+                yield (self.ticks[i], int.from_bytes(self.payload[offset+2:offset+5], 'big'))
+
+    def filter(self, predicate):
+        result = CompactTrack()
+        for deltamsg in self:
+            if predicate(deltamsg):
+                result.append_bytes(deltamsg.ticks, deltamsg.bytes)
+        return result
+
+    def note_keys(self):
+        'Yield (index, is_start, (channel, note)) for each note start and note end, as consumed by pair_notes.'
+        status, data1, data2 = self.status, self.data1, self.data2
+        for i in range(len(self)):
+            nibble = status[i] & 0xf0
+            if nibble == 0x90:
+                yield (i, data2[i] != 0, (status[i] & 0x0f, data1[i]))
+            elif nibble == 0x80:
+                yield (i, False, (status[i] & 0x0f, data1[i]))
+
+    def set_note_ends(self, pairs):
+        'Set note_ends from (start index, end index) pairs, such as those from pair_notes.'
+        self.note_ends = array.array('q', [-1]) * len(self)
+        for i, j in pairs:
+            self.note_ends[i] = j
+
+    def take(self, order):
+        'Keep the msgs at the indices in order, in that order. Note ends follow their msgs, and become -1 if their msg is not kept.'
+        new_indices = array.array('q', [-1]) * len(self)
+        for j, i in enumerate(order):
+            new_indices[i] = j
+        payload_indices = {i: j for j, i in enumerate(self.payload_events)}
+        payload_events = array.array('q')
+        payload_offsets = array.array('q', [0])
+        payload = bytearray()
+        status = self.status
+        for j, i in enumerate(order):
+            if status[i] >= 0xf0:
+                k = payload_indices[i]
+                payload_events.append(j)
+                payload += self.payload[self.payload_offsets[k]:self.payload_offsets[k+1]]
+                payload_offsets.append(len(payload))
+        self.ticks = array.array('q', map(self.ticks.__getitem__, order))
+        self.status = array.array('B', map(status.__getitem__, order))
+        self.data1 = array.array('B', map(self.data1.__getitem__, order))
+        self.data2 = array.array('B', map(self.data2.__getitem__, order))
+        self.note_ends = array.array('q', [new_indices[j] if j >= 0 else -1 for j in map(self.note_ends.__getitem__, order)])
+        self.payload_events = payload_events
+        self.payload_offsets = payload_offsets
+        self.payload = payload
+        self.edits += 1
+        return self
+
+    def sort(self):
+        'Stably sort msgs by ticks after their ticks have changed. End of track msgs are first moved to the last ticks, so they stay last.'
+        ticks = self.ticks
+        ticks_end = max(ticks, default=0)
+        for j, i in enumerate(self.payload_events):
+            if self.status[i] == 0xff and self.payload[self.payload_offsets[j]] == 0x2f:
+                ticks[i] = ticks_end
+        order = sorted(range(len(self)), key=ticks.__getitem__)
+        if order != list(range(len(self))): self.take(order)
+        return self
+
+    def transpose(self, semitones, channels=None, clip='clamp', low=0, high=0x7f):
+        '''Transpose note and polyphonic key pressure msgs, in place. channels limits which channels are transposed.
+        Notes that would leave [low, high] are clamped to it if clip is 'clamp', or removed if clip is 'drop'.'''
+        if clip not in ['clamp', 'drop']:
+            raise Exception(f'unknown clip {clip}')
+        if channels == None: channels = range(0x10)
+        data1 = self.data1
+        keep = []
+        for i, status in enumerate(self.status):
+            if 0x80 <= status < 0xb0 and status & 0x0f in channels:
+                num = data1[i] + semitones
+                if not low <= num <= high:
+                    if clip == 'drop': continue
+                    num = min(max(num, low), high)
+                data1[i] = num
+            keep.append(i)
+        self.edits += 1
+        if len(keep) != len(self): self.take(keep)
+        return self
+
+    def quantize(self, grid, ends=True):
+        '''Move paired note starts to the nearest multiple of grid ticks, in place, then sort.
+        If ends is true, note ends are moved to the nearest multiple too, but notes last at least grid. Otherwise notes keep their durations.'''
+        ticks = self.ticks
+        for i, j in enumerate(self.note_ends):
+            if j < 0: continue
+            start = (ticks[i] + grid // 2) // grid * grid
+            if ends:
+                end = max((ticks[j] + grid // 2) // grid * grid, start + grid)
+            else:
+                end = ticks[j] + start - ticks[i]
+            ticks[i] = start
+            ticks[j] = end
+        self.edits += 1
+        return self.sort()
+
+    def velocity_curve(self, curve):
+        '''Map the velocity of each note start through curve, in place.
+        curve is a function of velocity, or a sequence of 128 velocities. Results are rounded and clamped to [1, 127], so note starts stay note starts.'''
+        if callable(curve): curve = [curve(i) for i in range(0x80)]
+        table = bytes([0] + [min(max(round(curve[i]), 1), 0x7f) for i in range(1, 0x80)] + list(range(0x80, 0x100)))
+        mapped = bytes(self.data2).translate(table)
+        self.data2 = array.array('B', [
+            vel if status & 0xf0 == 0x90 else data2
+            for status, data2, vel in zip(self.status, self.data2, mapped)
+        ])
+        self.edits += 1
+        return self
+
+    def stretch(self, factor):
+        'Multiply the ticks of every msg by factor, rounding, in place. Tempo msgs keep their values, so the track plays factor times as long.'
+        self.ticks = array.array('q', [round(ticks * factor) for ticks in self.ticks])
+        self.edits += 1
+        self.tempo_edits += 1
+        return self
+
+    def remap_channels(self, mapping):
+        'Change the channel of each channel msg, in place. mapping is a dict of channel to channel, or a sequence of 16 channels.'
+        if not isinstance(mapping, dict): mapping = dict(enumerate(mapping))
+        table = bytes(i & 0xf0 | mapping.get(i & 0x0f, i & 0x0f) if i < 0xf0 else i for i in range(0x100))
+        self.status = array.array('B', bytes(self.status).translate(table))
+        self.edits += 1
+        return self
+
+    def columns(self):
+        'The columns as a dict of name to array. payload is a bytearray.'
+        return {name: getattr(self, name) for name in CompactTrack.column_names}
+
+    def from_columns(columns):
+        'Make a CompactTrack from columns like those of CompactTrack.columns. They are used as is, not copied.'
+        result = CompactTrack()
+        for name in CompactTrack.column_names:
+            setattr(result, name, columns[name])
+        return result
+
+    def from_track(track):
+        'Make a CompactTrack holding the same msgs and note pairing as a Track.'
+        result = CompactTrack()
+        indices = {id(deltamsg): i for i, deltamsg in enumerate(track)}
+        for deltamsg in track:
+            if deltamsg.note_end:
+                note_end = indices.get(id(deltamsg.note_end()), -1)
+            else:
+                note_end = -1
+            result.append(deltamsg, note_end)
+        return result
+
+    def to_track(self):
+        'Make a Track of Deltamsgs holding the same msgs. Note ends refer to the song this track is in, if any.'
+        deltamsgs = list(self)
+        for deltamsg in deltamsgs:
+            if deltamsg.note_end:
+                # hold on to the Track's deltamsg, so the Ref stays valid through edits
+                deltamsg.note_end.deltamsg = deltamsgs[deltamsg.note_end.deltamsg_index]
+        return Track(deltamsgs)
+
 class Song:
-    def __init__(self, file_path=None, file_bytes=None, ticks_per_quarter=360, track_count=2):
+    def __init__(self, file_path=None, file_bytes=None, ticks_per_quarter=360, track_count=2, overlap='fifo', compact=False, lazy=False, sysex=True, meta=True, split_channels=False, stats=None):
+        'stats is a Stats to instrument loading, saving and note pairing with, or None.'
+        self.format = 1
         self.ticks_per_quarter = ticks_per_quarter
         self.tracks = [Track() for i in range(track_count)]
+        self.mmap = None
+        self.caches = {}
+        self.stats = stats
         if file_path or file_bytes:
-            self.load(file_path, file_bytes)
+            self.load(file_path, file_bytes, overlap, compact, lazy, sysex, meta, split_channels)
 
     def __getitem__(self, i):
         return self.tracks[i]
@@ -340,35 +850,68 @@ class Song:
     def __len__(self):
         return len(self.tracks)
 
-    def save(self, file_path):
-        with open(file_path, 'wb') as file:
-            header = (
-                b'MThd'
-                + bytes([0, 0, 0, 6, 0, 1])
-                + len(self.tracks).to_bytes(2, 'big')
-                + self.ticks_per_quarter.to_bytes(2, 'big')
-            )
-            file.write(header)
-            for track in self.tracks:
-                track_bytes = []
-                for deltamsg in track:
-                    track_bytes.extend(deltamsg.delta_bytes())
-                    track_bytes.extend(deltamsg.msg_bytes())
-                if track_bytes[-4:] != [0x01, 0xff, 0x2f, 0x00]:
-                    track_bytes += [0x01, 0xff, 0x2f, 0x00]
-                track_header = b'MTrk' + len(track_bytes).to_bytes(4, 'big')
-                file.write(track_header + bytes(track_bytes))
-
-    def load(self, file_path=None, file_bytes=None):
+    def save(self, file, running_status=False):
+        '''Write a MIDI file to a path or to any writable file object.
+        Tracks are serialized and written one at a time, so only one track's bytes are held at once.
+        If running_status is true, repeated channel msg statuses are omitted.'''
+        if isinstance(file, (str, os.PathLike)):
+            with open(file, 'wb') as f:
+                return self.save(f, running_status)
+        stats = self.stats
+        file.write(self.header_bytes())
+        for track_index, track in enumerate(self.tracks):
+            if stats != None: record = stats.start('serialize', track_index=track_index, events=len(track))
+            chunk = write_track(bytearray(), track.events(), running_status)
+            if stats != None:
+                stats.stop(record, bytes=len(chunk))
+                record = stats.start('write', track_index=track_index, bytes=len(chunk))
+            file.write(chunk)
+            if stats != None: stats.stop(record)
+
+    def save_bytes(self, running_status=False):
+        'Serialize to a bytearray. See save.'
+        stats = self.stats
+        result = self.header_bytes()
+        for track_index, track in enumerate(self.tracks):
+            if stats != None: record = stats.start('serialize', track_index=track_index, events=len(track))
+            size = len(result)
+            write_track(result, track.events(), running_status)
+            if stats != None: stats.stop(record, bytes=len(result) - size)
+        return result
+
+    def header_bytes(self):
+        if self.format == 0 and len(self.tracks) != 1:
+            raise Exception('type 0 files have exactly one track')
+        return bytearray(
+            b'MThd'
+            + bytes([0, 0, 0, 6, 0, self.format])
+            + len(self.tracks).to_bytes(2, 'big')
+            + self.ticks_per_quarter.to_bytes(2, 'big')
+        )
+
+    def load(self, file_path=None, file_bytes=None, overlap='fifo', compact=False, lazy=False, sysex=True, meta=True, split_channels=False):
+        '''Load a type 0, 1 or 2 MIDI file. If compact is true, tracks are left as CompactTracks.
+        If lazy is true, a file is memory-mapped instead of read, and each track is decoded the first time it's accessed; see LazyTracks.
+        sysex and meta can skip payloads that aren't needed; see CompactTrack.parse.
+        If split_channels is true, a type 0 file is split by channel into a type 1 song; see Song.split_channels.'''
         # arg checks
         if file_path and file_bytes:
             raise Exception('cannot specify file more than one way')
-        if file_path:
+        self.close()
+        stats = self.stats
+        if stats != None: record = stats.start('read', lazy=lazy)
+        if file_path and lazy:
+            with open(file_path, 'rb') as file:
+                self.mmap = file_bytes = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        elif file_path:
             with open(file_path, 'rb') as file: file_bytes = file.read()
         elif file_bytes:
             file_bytes = bytes(file_bytes)
         else:
             raise Exception('must specify file')
+        if stats != None:
+            stats.stop(record, bytes=len(file_bytes))
+            record = stats.start('chunks')
         # get chunks
         index = 0
         chunks = []
@@ -383,9 +926,9 @@ class Song:
         chunk_id = file_bytes[:chunk_id_size]
         if chunk_id != chunk_id_header:
             raise(Exception(f'first chunk ID should be {chunk_id_header}, but got {chunk_id}'))
-        chunks.append(file_bytes[:header_size])
+        header = file_bytes[:header_size]
         index += header_size
-        # get track chunks
+        # get track chunks, as spans of file_bytes so they aren't copied
         while True:
             index_data = index + chunk_id_size + chunk_size_size
             if len(file_bytes) < index_data: break
@@ -396,75 +939,282 @@ class Song:
             track_end = index_data + track_size
             if len(file_bytes) < track_end:
                 raise Exception('track too long')
-            chunks.append(file_bytes[index:track_end])
+            chunks.append((index_data, track_end))
             index = track_end
         if index != len(file_bytes): raise Exception('malformed tracks')
         # handle header chunk
-        if int.from_bytes(chunks[0][8:10], 'big') != 1:
+        self.format = int.from_bytes(header[8:10], 'big')
+        if self.format not in [0, 1, 2]:
             raise Exception('unhandled file type')
-        if int.from_bytes(chunks[0][10:12], 'big') != len(chunks) - 1:
+        if int.from_bytes(header[10:12], 'big') != len(chunks):
             raise Exception('wrong number of tracks')
-        self.ticks_per_quarter = int.from_bytes(chunks[0][12:14], 'big')
+        if self.format == 0 and len(chunks) != 1:
+            raise Exception('type 0 files have exactly one track')
+        self.ticks_per_quarter = int.from_bytes(header[12:14], 'big')
+        if stats != None: stats.stop(record, format=self.format, tracks=len(chunks), bytes=index)
         # handle track chunks
-        self.tracks.clear()
-        for chunk in chunks[1:]:
-            track = Track()
-            index = chunk_id_size + chunk_size_size
-            running_status = None
-            while index < len(chunk):
-                # delta
-                delta = 0
-                for i in range(index, index+4):
-                    delta <<= 7
-                    delta += chunk[i] & 0x7f
-                    if not chunk[i] & 0x80: break
-                else: raise Exception('delta too big')
-                index = i+1
-                # msg - status
-                if chunk[index] & 0x80:
-                    status = chunk[index]
-                    if chunk[index] & 0xf0 != 0xf0:
-                        running_status = status
-                    index += 1
-                else:
-                    if not running_status: raise Exception('no status')
-                    status = running_status
-                # msg - data
-                if status & 0xf0 in [0x80, 0x90, 0xa0, 0xb0, 0xe0]:
-                    data = chunk[index:index+2]
-                    index += 2
-                elif status & 0xf0 in [0xc0, 0xd0]:
-                    data = chunk[index:index+1]
-                    index += 1
-                elif status & 0xf0 == 0xf0:
-                    if status == 0xff:
-                        data_size = 2 + chunk[index+1]
-                        data = chunk[index:index+data_size]
-                        index += data_size
-                    else:
-                        data = []
-                # deltamsg
-                deltamsg = Deltamsg(delta, bytes([status]) + data)
-                track.append(deltamsg)
-            if track[-1] != Msg(0xff, 0x2f, 0x00):
-                raise Exception('invalid last msg')
-            self.tracks.append(track)
-            # note ends
-            for i, v in enumerate(track):
-                if not v.is_note_start(): continue
-                for j, u in enumerate(track[i+1:]):
-                    if u.is_note_end() and u.note() == v.note():
-                        v.set_note_end(Ref(self, len(self.tracks)-1, i+1+j))
-                        break
+        self.tracks = LazyTracks(self, file_bytes, chunks, overlap, compact, sysex, meta)
+        if not lazy:
+            self.tracks = list(self.tracks)
+        if split_channels and self.format == 0:
+            self.split_channels(overlap)
+        return self
+
+    def split_channels(self, overlap='fifo'):
+        '''Split a type 0 song's one track into a track of system msgs, then a track per channel used, in channel order.
+        The song becomes type 1 and keeps its track representation.'''
+        if len(self.tracks) != 1:
+            raise Exception('can only split a song with one track')
+        track = self.tracks[0]
+        groups = {None: []}
+        for deltamsg in track:
+            channel = None if deltamsg.status() >= 0xf0 else deltamsg.channel()
+            groups.setdefault(channel, []).append((deltamsg.ticks, deltamsg.bytes))
+        ticks_end = track[-1].ticks if len(track) else 0
+        channels = [None] + sorted(i for i in groups if i != None)
+        self.tracks = []
+        for channel in channels:
+            msgs = groups[channel]
+            if not msgs or tuple(msgs[-1][1]) != (0xff, 0x2f, 0x00):
+                msgs.append((ticks_end, (0xff, 0x2f, 0x00)))
+            if isinstance(track, CompactTrack):
+                split = CompactTrack()
+                for ticks, bytes_ in msgs:
+                    split.append_bytes(ticks, bytes_)
+            else:
+                split = Track()
+                ticks_last = 0
+                for ticks, bytes_ in msgs:
+                    split.append(Deltamsg(ticks - ticks_last, bytes_, ticks))
+                    ticks_last = ticks
+            self.tracks.append(split)
+            self.pair_notes(len(self.tracks) - 1, overlap)
+        self.format = 1
+        return self
+
+    def close(self):
+        'Release the memory-mapped file of a lazy load. Tracks that have not been accessed yet can no longer be decoded.'
+        if self.mmap != None:
+            self.mmap.close()
+            self.mmap = None
+
+    def iter_track(self, track_index):
+        "Yield a track's Deltamsgs. If the track hasn't been decoded by a lazy load, they come straight from the file without decoding the whole track."
+        if isinstance(self.tracks, LazyTracks) and not self.tracks.decoded(track_index):
+            chunk_start, chunk_end = self.tracks.chunks[track_index]
+            return iter_chunk(self.tracks.buffer, chunk_start, chunk_end)
+        return iter(self.tracks[track_index])
+
+    def pair_notes(self, track_index, overlap='fifo'):
+        'Set the note_end of each note start in a track. See pair_notes for overlap.'
+        track = self.tracks[track_index]
+        track.edits += 1
+        stats = self.stats
+        if stats != None:
+            record = stats.start('pair', track_index=track_index, overlap=overlap)
+            keys = list(track.note_keys())
+            pairs = list(pair_notes(keys, overlap))
+            starts = sum(1 for i in keys if i[1])
+            stats.stop(record, starts=starts, ends=len(keys) - starts, pairs=len(pairs))
+        else:
+            pairs = pair_notes(track.note_keys(), overlap)
+        if isinstance(track, CompactTrack):
+            track.song = self
+            track.track_index = track_index
+            track.set_note_ends(pairs)
+            return
+        for i, j in pairs:
+            track[i].set_note_end(Ref(self, track_index, j))
+
+    def tempo_map(self):
+        'The TempoMap of this song. It is cached until a tempo msg is added to a track.'
+        edits = [(id(track), track.tempo_edits) for track in self.tracks]
+        cached = self.caches.get('tempo_map')
+        if cached == None or cached[0] != edits:
+            cached = self.caches['tempo_map'] = (edits, TempoMap(self))
+        return cached[1]
+
+    def segments(self, track_index, min_rest=0, tolerance=0):
+        'The Segments of a track. It is cached until the track is edited; to keep it up to date through edits instead, add and remove notes with Segments.add and Segments.remove too.'
+        track = self.tracks[track_index]
+        key = ('segments', track_index, min_rest, tolerance)
+        cached = self.caches.get(key)
+        if cached == None or cached[0] != (id(track), track.edits):
+            cached = self.caches[key] = ((id(track), track.edits), Segments.from_track(track, min_rest, tolerance))
+        return cached[1]
+
+    def note_index(self):
+        'The NoteIndex of this song. It is cached until a track is edited.'
+        edits = [(id(track), track.edits) for track in self.tracks]
+        cached = self.caches.get('note_index')
+        if cached == None or cached[0] != edits:
+            cached = self.caches['note_index'] = (edits, NoteIndex(self))
+        return cached[1]
+
+    def sounding(self, ticks_i, ticks_f=None, note_i=0, note_f=0xff):
+        '''Refs to the note starts of notes that sound at any point in [ticks_i, ticks_f), or at ticks_i if ticks_f is None.
+        Unlike select, this finds notes that start before the range. See NoteIndex.'''
+        if ticks_f == None:
+            notes = self.note_index().stab(ticks_i, note_i, note_f)
+        else:
+            notes = self.note_index().overlap(ticks_i, ticks_f, note_i, note_f)
+        return [
+            self.ref(track_index, deltamsg_index)
+            for ticks, ticks_end, track_index, deltamsg_index in sorted(notes)
+        ]
+
+    def notes(self, tracks=None):
+        '''The paired notes of the song as columns: a dict of arrays named start, end, pitch, velocity, channel and track.
+        Notes are ordered by track, then by start. tracks limits which track indices are included.
+        The arrays support the buffer protocol, so numpy.frombuffer can view them without copying.'''
+        result = {
+            'start': array.array('q'),
+            'end': array.array('q'),
+            'pitch': array.array('B'),
+            'velocity': array.array('B'),
+            'channel': array.array('B'),
+            'track': array.array('H'),
+        }
+        if tracks == None: tracks = range(len(self.tracks))
+        for track_index in tracks:
+            notes = list(self.tracks[track_index].notes())
+            if not notes: continue
+            starts, ends, pitches, velocities, channels = zip(*notes)
+            result['start'].extend(starts)
+            result['end'].extend(ends)
+            result['pitch'].extend(pitches)
+            result['velocity'].extend(velocities)
+            result['channel'].extend(channels)
+            result['track'].extend([track_index] * len(notes))
+        return result
+
+    def to_pianoroll(self, resolution=4, tracks=None, velocity=True):
+        '''Render paired notes into a piano roll: a list of 128 bytearrays, one per pitch, each with a cell per step.
+        resolution is steps per quarter note. Cells hold the note's velocity, or 1 if velocity is false, and 0 where nothing sounds.
+        Each note fills its cells with one slice assignment. Where notes of a pitch overlap, the later one in notes order wins.'''
+        notes = self.notes(tracks)
+        tpq = self.ticks_per_quarter
+        # every note fills at least its first cell, even one that ends where it starts
+        steps = max((max(-(-end * resolution // tpq), start * resolution // tpq + 1) for start, end in zip(notes['start'], notes['end'])), default=0)
+        result = [bytearray(steps) for i in range(128)]
+        for start, end, pitch, vel in zip(notes['start'], notes['end'], notes['pitch'], notes['velocity']):
+            if pitch >= 128: continue
+            i = start * resolution // tpq
+            f = max(end * resolution // tpq, i + 1)
+            result[pitch][i:f] = bytes([vel if velocity else 1]) * (f - i)
+        return result
+
+    def from_notes(notes, ticks_per_quarter=360):
+        '''Make a song from note columns like those of Song.notes. NumPy structured arrays work too.
+        start, end and pitch are required. velocity defaults to 0x40, track to 1, and channel to track - 1 (or 0 for track 0), following add_note.
+        Each track's msgs are added with one Track.add_many.'''
+        count = len(notes['start'])
+        def column(name, default):
+            try:
+                return [int(i) for i in notes[name]]
+            except (KeyError, ValueError):
+                return [default(k) for k in range(count)]
+        starts = [int(i) for i in notes['start']]
+        ends = [int(i) for i in notes['end']]
+        pitches = [int(i) for i in notes['pitch']]
+        velocities = column('velocity', lambda k: 0x40)
+        tracks = column('track', lambda k: 1)
+        channels = column('channel', lambda k: max(tracks[k] - 1, 0))
+        song = Song(ticks_per_quarter=ticks_per_quarter, track_count=max(tracks, default=0) + 1)
+        msgs = [[] for i in song.tracks]
+        for k in range(count):
+            msgs[tracks[k]].append((Msg.note_on(pitches[k], velocities[k], channels[k]), starts[k]))
+            msgs[tracks[k]].append((Msg.note_off(pitches[k], 0x40, channels[k]), ends[k]))
+        for track_index, track_msgs in enumerate(msgs):
+            added = song.tracks[track_index].add_many(track_msgs)
+            for i in range(0, len(added), 2):
+                added[i].note_end = Ref(song, track_index, None, added[i+1])
+        return song
+
+    def transform(self, f, tracks=None, pair=True, overlap='fifo'):
+        '''Call f on each track as a CompactTrack, then if pair is true, pair notes again once.
+        A Track is converted to a CompactTrack for f and back after, so Refs taken before a transform don't follow it.
+        tracks limits which track indices are transformed.'''
+        if tracks == None: tracks = range(len(self.tracks))
+        for track_index in tracks:
+            track = self.tracks[track_index]
+            if isinstance(track, CompactTrack):
+                compact = track
+            else:
+                compact = CompactTrack.from_track(track)
+                compact.edits = track.edits
+                compact.tempo_edits = track.tempo_edits
+            compact.song = self
+            compact.track_index = track_index
+            f(compact)
+            self.tracks[track_index] = compact
+            if pair: self.pair_notes(track_index, overlap)
+            if compact is not track:
+                self.tracks[track_index] = compact.to_track()
+                self.tracks[track_index].edits = compact.edits
+                self.tracks[track_index].tempo_edits = compact.tempo_edits
+        return self
+
+    def transpose(self, semitones, tracks=None, channels=None, clip='clamp', low=0, high=0x7f, overlap='fifo'):
+        'Transpose notes of every track, or of tracks. See CompactTrack.transpose.'
+        return self.transform(lambda track: track.transpose(semitones, channels, clip, low, high), tracks, True, overlap)
+
+    def quantize(self, grid, tracks=None, ends=True, overlap='fifo'):
+        'Quantize notes of every track, or of tracks, to grid ticks. See CompactTrack.quantize.'
+        return self.transform(lambda track: track.quantize(grid, ends), tracks, True, overlap)
+
+    def velocity_curve(self, curve, tracks=None):
+        'Map note start velocities of every track, or of tracks, through curve. See CompactTrack.velocity_curve.'
+        return self.transform(lambda track: track.velocity_curve(curve), tracks, False)
+
+    def stretch(self, factor):
+        'Stretch every track in time by factor, keeping tempo msgs as they are. See CompactTrack.stretch.'
+        return self.transform(lambda track: track.stretch(factor), None, False)
+
+    def remap_channels(self, mapping, tracks=None, overlap='fifo'):
+        'Remap channels of every track, or of tracks. See CompactTrack.remap_channels.'
+        return self.transform(lambda track: track.remap_channels(mapping), tracks, True, overlap)
+
+    def compact(self):
+        'Convert each Track to a CompactTrack, keeping note pairing.'
+        for track_index, track in enumerate(self.tracks):
+            if isinstance(track, CompactTrack): continue
+            compact = CompactTrack.from_track(track)
+            compact.song = self
+            compact.track_index = track_index
+            self.tracks[track_index] = compact
+        return self
+
+    def expand(self):
+        'Convert each CompactTrack to a Track, keeping note pairing.'
+        for track_index, track in enumerate(self.tracks):
+            if not isinstance(track, CompactTrack): continue
+            track.song = self
+            track.track_index = track_index
+            self.tracks[track_index] = track.to_track()
         return self
 
     def add_note(self, track_index, ticks, duration, num, channel=None, vel_on=0x40, vel_off=0x40):
         if channel == None:
             assert track_index != 0
             channel = track_index - 1
-        on = self.tracks[track_index].add(Msg.note_on(num, vel_on, channel), ticks)
-        off = self.tracks[track_index].add(Msg.note_off(num, vel_off, channel), ticks + duration)
-        Ref(self, track_index, on)().set_note_end(Ref(self, track_index, off))
+        on = Ref(self, track_index, self.tracks[track_index].add(Msg.note_on(num, vel_on, channel), ticks))
+        on().set_note_end(Ref(self, track_index, self.tracks[track_index].add(Msg.note_off(num, vel_off, channel), ticks + duration)))
+
+    def add_notes(self, track_index, notes, channel=None):
+        '''Add many notes at once with Track.add_many.
+        notes is an iterable of (ticks, duration, num), optionally followed by vel_on and vel_off; see add_note.'''
+        if channel == None:
+            assert track_index != 0
+            channel = track_index - 1
+        msgs = []
+        for ticks, duration, num, *vels in notes:
+            vel_on, vel_off = (*vels, 0x40, 0x40)[:2]
+            msgs.append((Msg.note_on(num, vel_on, channel), ticks))
+            msgs.append((Msg.note_off(num, vel_off, channel), ticks + duration))
+        added = self.tracks[track_index].add_many(msgs)
+        for i in range(0, len(added), 2):
+            added[i].note_end = Ref(self, track_index, None, added[i+1])
 
     def prev(self, track_index, ticks, predicate=None):
         track = self.tracks[track_index]
@@ -473,7 +1223,7 @@ class Song:
             if i < 0:
                 return
             if predicate == None or predicate(track[i]):
-                return Ref(self, track_index, i)
+                return self.ref(track_index, i)
             i -= 1
 
     def select(
@@ -502,35 +1252,661 @@ class Song:
                 if deltamsg.ticks < ticks_i: continue
                 if predicate != None and not predicate(deltamsg): continue
                 if note_i != None and deltamsg.has_note() and not note_i <= deltamsg.note() <= note_f: continue
-                result.append(Ref(self, track_index, deltamsg_index))
+                result.append(self.ref(track_index, deltamsg_index))
         return result
 
+    def ref(self, track_index, deltamsg_index):
+        'A Ref to a deltamsg. For a Track, it holds on to the deltamsg from the start, so it stays valid through edits made before it is first called.'
+        track = self.tracks[track_index]
+        return Ref(self, track_index, deltamsg_index, track[deltamsg_index] if isinstance(track, Track) else None)
+
     def filterleave(self, predicate):
         'Filter each track, then interleave them. Useful to get all msgs of a specific type into one track.'
         return interleave(*[i.filter(predicate) for i in self.tracks])
 
+    def stream(self, tracks=None):
+        '''A Stream of the msgs of every track, or of tracks, a list of track indices.
+        Tracks not yet decoded by a lazy load are streamed straight from the file; see iter_track.'''
+        if tracks == None: tracks = range(len(self.tracks))
+        return Stream([self.iter_track(i) for i in tracks], self.ticks_per_quarter, self.format, self.stats)
+
+class Stats:
+    '''Instrumentation of a song's loading, saving and note pairing, kept as song.stats.
+    It is off unless a Stats is passed to Song or set as song.stats. While off, each instrumented step costs one comparison with None.
+    Each timed phase adds a record to records: a dict of phase, seconds, and what the phase measured, such as track_index, bytes, events or pairs.
+    The phases are read, chunks, decode, pair, expand, serialize, write and stream.
+    Each callback is called with each record as it is made, for example to pass records on to a logger.'''
+
+    def __init__(self, callbacks=None, clock=time.perf_counter):
+        self.records = []
+        self.callbacks = [] if callbacks == None else list(callbacks)
+        self.clock = clock
+
+    def start(self, phase, **fields):
+        'Start timing a phase. Returns its record, to pass to stop.'
+        return {'phase': phase, **fields, 'start': self.clock()}
+
+    def stop(self, record, **fields):
+        'Finish timing a phase started with start, adding fields to its record.'
+        record['seconds'] = self.clock() - record.pop('start')
+        record.update(fields)
+        self.records.append(record)
+        for callback in self.callbacks:
+            callback(record)
+        return record
+
+    @contextlib.contextmanager
+    def phase(self, phase, **fields):
+        'Time the body of a with block as a phase. The with target is the record, which the body can add fields to.'
+        record = self.start(phase, **fields)
+        try:
+            yield record
+        finally:
+            self.stop(record)
+
+    def clear(self):
+        self.records = []
+
+    def totals(self):
+        'A dict of phase to a dict of count, seconds, and the sum of each other numeric field but track_index.'
+        result = {}
+        for record in self.records:
+            total = result.setdefault(record['phase'], {'count': 0})
+            total['count'] += 1
+            for key, value in record.items():
+                if key == 'track_index' or type(value) not in [int, float]: continue
+                total[key] = total.get(key, 0) + value
+        return result
+
+    def events_per_track(self):
+        'A dict of track index to the number of events decoded.'
+        return {i['track_index']: i['events'] for i in self.records if i['phase'] == 'decode'}
+
+    def export(self, file):
+        'Write the records as JSON lines to a path or to any writable text file object.'
+        if isinstance(file, (str, os.PathLike)):
+            with open(file, 'w') as f:
+                return self.export(f)
+        for record in self.records:
+            file.write(json.dumps(record) + '\n')
+
+    def __str__(self):
+        lines = []
+        for phase, total in self.totals().items():
+            details = ', '.join(f'{key} {value}' for key, value in total.items() if key not in ['count', 'seconds'])
+            lines.append(f'{phase:<10} {total["count"]:>5}x {total["seconds"]:10.6f} s  {details}')
+        return '\n'.join(lines)
+
+class LazyTracks(collections.abc.MutableSequence):
+    '''The tracks of a song, decoded from their chunks the first time each one is accessed.
+    buffer holds the file, and chunks holds the span of each track chunk's data within it, or None for tracks added since.
+    Everything that reads tracks, like iterating, reversed, index and pop, goes through indexing, so it never sees a track that isn't decoded.'''
+
+    def __init__(self, song, buffer, chunks, overlap='fifo', compact=False, sysex=True, meta=True):
+        self._tracks = [None] * len(chunks)
+        self.song = song
+        self.buffer = buffer
+        self.chunks = list(chunks)
+        self.overlap = overlap
+        self.compact = compact
+        self.sysex = sysex
+        self.meta = meta
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        track = self._tracks[i]
+        if track != None: return track
+        if i < 0: i += len(self)
+        chunk_start, chunk_end = self.chunks[i]
+        stats = self.song.stats
+        if stats != None: record = stats.start('decode', track_index=i, bytes=chunk_end - chunk_start)
+        track = CompactTrack.parse(self.buffer, chunk_start, chunk_end, self.sysex, self.meta)
+        if stats != None: stats.stop(record, events=len(track))
+        if not len(track) or track.msg(len(track) - 1) != (0xff, 0x2f, 0x00):
+            raise Exception('invalid last msg')
+        self._tracks[i] = track
+        self.song.pair_notes(i, self.overlap)
+        if not self.compact:
+            if stats != None: record = stats.start('expand', track_index=i, events=len(track))
+            self._tracks[i] = track = track.to_track()
+            if stats != None: stats.stop(record)
+        return track
+
+    def __setitem__(self, i, track):
+        if isinstance(i, slice):
+            raise TypeError('lazy tracks are set one at a time')
+        self._tracks[i] = track
+
+    def __delitem__(self, i):
+        del self._tracks[i]
+        del self.chunks[i]
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def insert(self, i, track):
+        self._tracks.insert(i, track)
+        self.chunks.insert(i, None)
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.abc.Sequence): return NotImplemented
+        return list(self) == list(other)
+
+    def copy(self):
+        'The tracks as a list, decoding any that aren\'t yet.'
+        return list(self)
+
+    def decoded(self, i):
+        return self._tracks[i] != None
+
+class Segments:
+    '''Phrases, rests and chords of a track's paired notes, found in one sweep and kept up to date as notes are added and removed.
+    Notes are held as columns sorted by start and then pitch: starts, ends, pitches and channels. Phrases and chords are ranges of positions in these columns, not lists of msgs.
+    A phrase ends where no note sounds for more than min_rest ticks; those gaps are the rests. A chord is the notes of a phrase that start within tolerance ticks of its first note.'''
+
+    def __init__(self, notes=(), min_rest=0, tolerance=0):
+        'notes is an iterable of (start ticks, end ticks, note, velocity, channel), as from Track.notes.'
+        self.min_rest = min_rest
+        self.tolerance = tolerance
+        notes = sorted((start, num, end, channel) for start, end, num, vel, channel in notes)
+        self.starts = array.array('q', [i[0] for i in notes])
+        self.pitches = array.array('B', [i[1] for i in notes])
+        self.ends = array.array('q', [i[2] for i in notes])
+        self.channels = array.array('B', [i[3] for i in notes])
+        # positions of the first note of each phrase and chord, and the latest end of each phrase
+        self.phrase_starts, self.phrase_ends, self.chord_starts = self.sweep(0, len(notes))
+
+    def from_track(track, min_rest=0, tolerance=0):
+        return Segments(track.notes(), min_rest, tolerance)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def sweep(self, i, f):
+        'Find the phrases and chords of notes [i, f), where i is the first note of a phrase and f is the first note of another or the end. Returns (phrase starts, phrase ends, chord starts).'
+        starts, ends = self.starts, self.ends
+        min_rest, tolerance = self.min_rest, self.tolerance
+        phrase_starts = []
+        phrase_ends = []
+        chord_starts = []
+        end = None
+        for k in range(i, f):
+            start = starts[k]
+            if end == None or start - end > min_rest:
+                if end != None: phrase_ends.append(end)
+                phrase_starts.append(k)
+                chord_starts.append(k)
+                chord = start
+                end = ends[k]
+                continue
+            if start - chord > tolerance:
+                chord_starts.append(k)
+                chord = start
+            if ends[k] > end: end = ends[k]
+        if end != None: phrase_ends.append(end)
+        return (phrase_starts, phrase_ends, chord_starts)
+
+    def resweep(self, i, f):
+        'Sweep notes [i, f) again and splice in what was found, after notes there were added or removed.'
+        phrase_starts, phrase_ends, chord_starts = self.sweep(i, f)
+        a = bisect.bisect_left(self.phrase_starts, i)
+        b = bisect.bisect_left(self.phrase_starts, f)
+        self.phrase_starts[a:b] = phrase_starts
+        self.phrase_ends[a:b] = phrase_ends
+        a = bisect.bisect_left(self.chord_starts, i)
+        b = bisect.bisect_left(self.chord_starts, f)
+        self.chord_starts[a:b] = chord_starts
+
+    def position(self, start, num, end=None, channel=None):
+        '''The position of the first note starting at start with pitch num or higher.
+        Given end, and then channel too, notes of the same start and pitch are ordered by them, as the columns are, so this is where such a note goes.'''
+        key = (num,) if end == None else (num, end) if channel == None else (num, end, channel)
+        i = bisect.bisect_left(self.starts, start)
+        while i < len(self) and self.starts[i] == start and (self.pitches[i], self.ends[i], self.channels[i])[:len(key)] < key: i += 1
+        return i
+
+    def add(self, start, end, num, channel=0):
+        'Add a note, sweeping again only from the phrase before it to the first phrase it cannot reach.'
+        p = self.position(start, num, end, channel)
+        self.starts.insert(p, start)
+        self.ends.insert(p, end)
+        self.pitches.insert(p, num)
+        self.channels.insert(p, channel)
+        self.phrase_starts = [k + (k >= p) for k in self.phrase_starts]
+        self.chord_starts = [k + (k >= p) for k in self.chord_starts]
+        # the note can join the phrase of the note before it, and the phrases after it until one starts after a long enough rest
+        j = bisect.bisect_right(self.phrase_starts, max(p - 1, 0)) - 1
+        i = self.phrase_starts[j] if j >= 0 else 0
+        m = bisect.bisect_right(self.phrase_starts, p)
+        while m < len(self.phrase_starts) and self.starts[self.phrase_starts[m]] - max(self.phrase_ends[m-1], end) <= self.min_rest:
+            m += 1
+        self.resweep(i, self.phrase_starts[m] if m < len(self.phrase_starts) else len(self))
+
+    def remove(self, start, end, num, channel=0):
+        'Remove a note, sweeping again only its phrase. Raises if there is no such note.'
+        p = self.position(start, num, end, channel)
+        if p >= len(self) or (self.starts[p], self.ends[p], self.pitches[p], self.channels[p]) != (start, end, num, channel):
+            raise Exception('no such note')
+        j = bisect.bisect_right(self.phrase_starts, p) - 1
+        i = self.phrase_starts[j]
+        f = self.phrase_starts[j+1] - 1 if j + 1 < len(self.phrase_starts) else len(self) - 1
+        del self.starts[p], self.ends[p], self.pitches[p], self.channels[p]
+        # the removed note's own phrase and chord starts go; resweep finds whatever starts there now
+        self.phrase_ends = [end for k, end in zip(self.phrase_starts, self.phrase_ends) if k != p]
+        self.phrase_starts = [k - (k > p) for k in self.phrase_starts if k != p]
+        self.chord_starts = [k - (k > p) for k in self.chord_starts if k != p]
+        self.resweep(i, f)
+
+    def ranges(self, firsts):
+        return list(zip(firsts, firsts[1:] + [len(self)]))
+
+    def phrases(self):
+        'The phrases as (first position, position after the last).'
+        return self.ranges(self.phrase_starts)
+
+    def chords(self):
+        'The chords as (first position, position after the last).'
+        return self.ranges(self.chord_starts)
+
+    def rests(self):
+        'The rests between phrases as (start ticks, end ticks).'
+        return [(self.phrase_ends[k], self.starts[self.phrase_starts[k+1]]) for k in range(len(self.phrase_starts) - 1)]
+
+    def msg_ranges(self, track):
+        'The phrases as ranges of msg indices of track, which together cover it, like Track.split without copying.'
+        bounds = [0]
+        for k in self.phrase_starts[1:]:
+            bounds.append(bisect.bisect_left(track, self.starts[k], key=lambda i: i.ticks))
+        bounds.append(len(track))
+        return list(zip(bounds, bounds[1:]))
+
+class NoteIndex:
+    '''Index of a song's paired notes, for finding what sounds when.
+    Notes are (start ticks, end ticks, track index, deltamsg index). They're grouped by note number, and each group is held sorted by start and in a centered interval tree.
+    Queries take O(log n + k) per note number in range.'''
+
+    def __init__(self, song):
+        self.notes = {}
+        self.starts = {}
+        self.trees = {}
+        for track_index, track in enumerate(song.tracks):
+            for deltamsg_index, deltamsg in enumerate(track):
+                if not deltamsg.note_end: continue
+                note = (deltamsg.ticks, deltamsg.note_end().ticks, track_index, deltamsg_index)
+                self.notes.setdefault(deltamsg.note(), []).append(note)
+        for num, notes in self.notes.items():
+            notes.sort()
+            self.starts[num] = [i[0] for i in notes]
+            self.trees[num] = _interval_tree([i for i in notes if i[0] < i[1]])
+
+    def stab(self, ticks, note_i=0, note_f=0xff):
+        'Yield the notes sounding at ticks, that is with start <= ticks < end.'
+        for num in range(note_i, note_f + 1):
+            tree = self.trees.get(num)
+            while tree:
+                center, by_start, by_end, left, right = tree
+                if ticks < center:
+                    for note in by_start:
+                        if note[0] > ticks: break
+                        yield note
+                    tree = left
+                else:
+                    for note in by_end:
+                        if note[1] <= ticks: break
+                        yield note
+                    tree = right if ticks > center else None
+
+    def overlap(self, ticks_i, ticks_f, note_i=0, note_f=0xff):
+        'Yield the notes sounding at any point in [ticks_i, ticks_f).'
+        yield from self.stab(ticks_i, note_i, note_f)
+        for num in range(note_i, note_f + 1):
+            starts = self.starts.get(num)
+            if not starts: continue
+            notes = self.notes[num]
+            for i in range(bisect.bisect_right(starts, ticks_i), bisect.bisect_left(starts, ticks_f)):
+                if notes[i][0] < notes[i][1]:
+                    yield notes[i]
+
+def _interval_tree(notes):
+    # node is [center, notes containing center by start, same by end descending, left subtree, right subtree]
+    # center is the start of the median note, so each node holds at least one note and each side at most half
+    if not notes: return None
+    center = notes[len(notes) // 2][0]
+    left = [i for i in notes if i[1] <= center]
+    right = [i for i in notes if i[0] > center]
+    here = [i for i in notes if i[0] <= center < i[1]]
+    return [
+        center,
+        here,
+        sorted(here, key=lambda i: i[1], reverse=True),
+        _interval_tree(left),
+        _interval_tree(right),
+    ]
+
+class TempoMap:
+    '''Tempo changes of a song, for converting between ticks and seconds in O(log n).
+    ticks holds the ticks of each tempo change, starting with 0 at the default of 500000 us per quarter.
+    us holds the microseconds elapsed at each change, and us_per_quarter the tempo from it on.'''
+
+    def __init__(self, song):
+        self.ticks_per_quarter = song.ticks_per_quarter
+        self.ticks = [0]
+        self.us = [0]
+        self.us_per_quarter = [500000]
+        changes = sorted(
+            (change for track in song.tracks for change in track.tempo_changes()),
+            key=lambda i: i[0],
+        )
+        for ticks, us_per_quarter in changes:
+            if ticks == self.ticks[-1]:
+                self.us_per_quarter[-1] = us_per_quarter
+                continue
+            self.us.append(self.us[-1] + (ticks - self.ticks[-1]) * self.us_per_quarter[-1] / self.ticks_per_quarter)
+            self.ticks.append(ticks)
+            self.us_per_quarter.append(us_per_quarter)
+
+    def ticks_to_seconds(self, ticks):
+        'Convert ticks to seconds. ticks can also be an iterable of them, giving an array of floats. Any real number counts as one tick value, NumPy scalars included.'
+        if not isinstance(ticks, numbers.Real):
+            return array.array('d', map(self.ticks_to_seconds, ticks))
+        i = max(bisect.bisect_right(self.ticks, ticks) - 1, 0)
+        return (self.us[i] + (ticks - self.ticks[i]) * self.us_per_quarter[i] / self.ticks_per_quarter) / 1e6
+
+    def seconds_to_ticks(self, seconds):
+        'Convert seconds to fractional ticks. seconds can also be an iterable of them, giving an array of floats.'
+        if not isinstance(seconds, numbers.Real):
+            return array.array('d', map(self.seconds_to_ticks, seconds))
+        us = seconds * 1e6
+        i = max(bisect.bisect_right(self.us, us) - 1, 0)
+        return self.ticks[i] + (us - self.us[i]) * self.ticks_per_quarter / self.us_per_quarter[i]
+
+class Player:
+    '''Plays a song in real time by calling sink(msg_bytes, deadline) for each msg that isn't meta. msg_bytes are as sent on the wire, so SysEx has no length.
+    Deadlines are clock times, fixed when playing starts or seeks, so late wakeups don't accumulate into drift.
+    Msgs due within lookahead seconds of each other are dispatched together, early; sinks that can schedule msgs can use deadline.
+    lateness records how late each msg was dispatched relative to its deadline, in seconds.'''
+
+    def __init__(self, song, sink, lookahead=0, clock=time.monotonic):
+        self.sink = sink
+        self.lookahead = lookahead
+        self.clock = clock
+        self.tempo_map = song.tempo_map()
+        self.ticks = []
+        self.msgs = []
+        for ticks, track_index, deltamsg in merge(*song):
+            if deltamsg.is_meta(): continue
+            self.ticks.append(ticks)
+            bytes_ = bytes(deltamsg.bytes)
+            if deltamsg.is_sysex():
+                # files put a length after the status, which the wire doesn't have; escapes send only their data
+                length, i = read_vlq(bytes_, 1)
+                bytes_ = (b'\xf0' if bytes_[0] == 0xf0 else b'') + bytes_[i:]
+            self.msgs.append(bytes_)
+        self.seconds = self.tempo_map.ticks_to_seconds(self.ticks)
+        self.lateness = array.array('d')
+        self.seek_ticks = 0
+        self.loop_ticks = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def seek(self, ticks):
+        'Continue playing from ticks.'
+        self.seek_ticks = ticks
+
+    def loop(self, ticks_i, ticks_f):
+        'Jump back to ticks_i whenever playing reaches ticks_f. Set loop_ticks to None to stop looping.'
+        assert ticks_i < ticks_f
+        self.loop_ticks = (ticks_i, ticks_f)
+
+    def steps(self):
+        '''Dispatch msgs as they come due, yielding how many seconds to wait whenever none are.
+        play and play_async drive this; driving it with a fake clock tests timing without waiting.
+        Stopping leaves the player positioned to continue from the next msg, and finishing rewinds it.'''
+        i = 0
+        origin = 0
+        while not self.stopping.is_set():
+            if self.seek_ticks != None:
+                i = bisect.bisect_left(self.ticks, self.seek_ticks)
+                origin = self.clock() - self.tempo_map.ticks_to_seconds(self.seek_ticks)
+                self.seek_ticks = None
+            ticks_f = self.loop_ticks[1] if self.loop_ticks else math.inf
+            if i >= len(self.ticks) or self.ticks[i] >= ticks_f:
+                if ticks_f == math.inf:
+                    self.seek_ticks = 0
+                    return
+                # loop
+                jump = origin + self.tempo_map.ticks_to_seconds(ticks_f)
+                wait = jump - self.lookahead - self.clock()
+                if wait > 0:
+                    yield wait
+                    continue
+                origin = jump - self.tempo_map.ticks_to_seconds(self.loop_ticks[0])
+                i = bisect.bisect_left(self.ticks, self.loop_ticks[0])
+                continue
+            now = self.clock()
+            wait = origin + self.seconds[i] - self.lookahead - now
+            if wait > 0:
+                yield wait
+                continue
+            horizon = now + self.lookahead
+            while i < len(self.ticks) and self.ticks[i] < ticks_f:
+                deadline = origin + self.seconds[i]
+                if deadline > horizon: break
+                self.sink(self.msgs[i], deadline)
+                self.lateness.append(now - deadline)
+                i += 1
+        if self.seek_ticks == None:
+            self.seek_ticks = self.ticks[i] if i < len(self.ticks) else 0
+
+    def play(self):
+        'Play until the end, or until stop is called from another thread.'
+        self.stopping.clear()
+        for wait in self.steps():
+            self.stopping.wait(wait)
+
+    async def play_async(self):
+        'Play until the end, or until stop is called.'
+        self.stopping.clear()
+        for wait in self.steps():
+            await asyncio.sleep(wait)
+
+    def start(self):
+        'Play in a background thread.'
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.play, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread and self.thread != threading.current_thread():
+            self.thread.join()
+            self.thread = None
+
+    def stats(self):
+        'Summarize lateness in seconds: count, mean, max, and jitter as its standard deviation.'
+        return {
+            'count': len(self.lateness),
+            'mean': statistics.fmean(self.lateness) if self.lateness else 0,
+            'max': max(self.lateness, default=0),
+            'jitter': statistics.pstdev(self.lateness) if self.lateness else 0,
+        }
+
+class RecordingSink:
+    'Player sink that records (time dispatched, deadline, msg bytes), for checking timing offline.'
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.records = []
+
+    def __call__(self, msg_bytes, deadline):
+        self.records.append((self.clock(), deadline, msg_bytes))
+
+class Capture:
+    '''Records live MIDI into a track of a song through a preallocated ring buffer.
+    A producer, such as the callback of a MIDI input on its own thread, calls put with each msg's raw bytes and timestamp. put only writes into preallocated arrays, so a long session allocates nothing per msg until it's drained.
+    A consumer calls drain now and then to convert what's waiting, in a batch, to ticks with the song's TempoMap and append it to the track, a CompactTrack. Note ends are paired with their starts as they arrive, by overlap; see pair_notes.
+    Timestamps are seconds on clock, and start is the time of ticks 0.
+    One producer and one consumer can run at once without locks. When the buffer is full, put drops msgs and counts them in overflows.'''
+
+    def __init__(self, song, track_index, capacity=1 << 16, msg_size=3, overlap='fifo', clock=time.monotonic, start=None):
+        'msg_size is the most bytes a msg can have, including its status. Longer msgs, like SysEx longer than msg_size, are dropped and counted in oversized.'
+        if overlap not in ['fifo', 'lifo', 'all']:
+            raise Exception(f'unknown overlap policy {overlap}')
+        track = song.tracks[track_index]
+        if not isinstance(track, CompactTrack):
+            track = song.tracks[track_index] = CompactTrack.from_track(track)
+        track.song = song
+        track.track_index = track_index
+        self.song = song
+        self.track = track
+        self.capacity = capacity
+        self.msg_size = msg_size
+        self.overlap = overlap
+        self.clock = clock
+        self.start = clock() if start == None else start
+        self.times = array.array('d', [0]) * capacity
+        self.sizes = array.array('B', [0]) * capacity
+        self.data = bytearray(capacity * msg_size)
+        # written and read count msgs ever put and drained; written - read are waiting
+        self.written = 0
+        self.read = 0
+        self.opened = {}
+        # captured msgs go after what's already there, so an end of track msg moves to after them when finishing
+        self.ticks_end = 0
+        if len(track) and track.status[-1] == 0xff and track.msg(len(track) - 1)[1] == 0x2f:
+            self.ticks_end = track.ticks[-1]
+            track.pop()
+        self.ticks_last = track.ticks[-1] if len(track) else 0
+        self.overflows = 0
+        self.oversized = 0
+        self.ignored = 0
+        self.latency_total = 0
+        self.latency_max = 0
+
+    def put(self, bytes_, timestamp=None):
+        'Add a msg, received at timestamp or now. Returns whether there was room for it.'
+        written = self.written
+        if written - self.read >= self.capacity:
+            self.overflows += 1
+            return False
+        size = len(bytes_)
+        if size > self.msg_size:
+            self.oversized += 1
+            return False
+        slot = written % self.capacity
+        offset = slot * self.msg_size
+        self.data[offset:offset+size] = bytes_
+        self.sizes[slot] = size
+        self.times[slot] = self.clock() if timestamp == None else timestamp
+        self.written = written + 1
+        return True
+
+    def drain(self, limit=None):
+        '''Append the waiting msgs, or at most limit of them, to the track. Returns how many were drained.
+        Msgs other than channel msgs and SysEx, like clock and active sensing, can't go in a MIDI file, so they are counted in ignored and left out, as are channel msgs of the wrong length.'''
+        now = self.clock()
+        count = self.written - self.read
+        if limit != None: count = min(count, limit)
+        tempo_map = self.song.tempo_map()
+        track = self.track
+        note_ends = track.note_ends
+        opened = self.opened
+        status_lengths = Msg.status_lengths
+        for k in range(self.read, self.read + count):
+            slot = k % self.capacity
+            offset = slot * self.msg_size
+            bytes_ = self.data[offset:offset+self.sizes[slot]]
+            # the msg is copied out, so its slot is free even if appending it fails
+            self.read = k + 1
+            latency = now - self.times[slot]
+            self.latency_total += latency
+            if latency > self.latency_max: self.latency_max = latency
+            status = bytes_[0] if bytes_ else 0
+            if status > 0xf0 or status < 0x80 or status_lengths[status] not in [None, len(bytes_)]:
+                self.ignored += 1
+                continue
+            if status == 0xf0:
+                bytes_ = b'\xf0' + write_vlq(len(bytes_) - 1) + bytes_[1:]
+            # clocks can step back a little between threads, but ticks can't
+            ticks = max(round(tempo_map.seconds_to_ticks(self.times[slot] - self.start)), self.ticks_last)
+            self.ticks_last = ticks
+            index = len(track)
+            track.append_bytes(ticks, bytes_)
+            nibble = status & 0xf0
+            if nibble == 0x90 and bytes_[2]:
+                opened.setdefault((status & 0x0f, bytes_[1]), collections.deque()).append(index)
+            elif nibble == 0x80 or nibble == 0x90:
+                starts = opened.get((status & 0x0f, bytes_[1]))
+                if not starts: continue
+                if self.overlap == 'fifo':
+                    note_ends[starts.popleft()] = index
+                elif self.overlap == 'lifo':
+                    note_ends[starts.pop()] = index
+                else:
+                    while starts: note_ends[starts.popleft()] = index
+        return count
+
+    def finish(self):
+        'Drain everything waiting, then end the track with an end of track msg at the ticks of now, or where the track ended before if that is later.'
+        self.drain()
+        ticks = max(round(self.song.tempo_map().seconds_to_ticks(self.clock() - self.start)), self.ticks_last, self.ticks_end)
+        self.track.append_bytes(ticks, (0xff, 0x2f, 0x00))
+        return self.track
+
+    def stats(self):
+        'Counters: msgs received, drained, waiting, overflows, oversized and ignored, and the mean and max seconds from put to drain.'
+        return {
+            'received': self.written + self.overflows + self.oversized,
+            'drained': self.read,
+            'waiting': self.written - self.read,
+            'overflows': self.overflows,
+            'oversized': self.oversized,
+            'ignored': self.ignored,
+            'latency_mean': self.latency_total / self.read if self.read else 0,
+            'latency_max': self.latency_max,
+        }
+
 class Ref:
-    def __init__(self, song, track_index, deltamsg_index):
+    '''Reference to a deltamsg in a song.
+    Once called, a Ref to a Track holds on to the deltamsg itself, so it stays valid as msgs are added and removed around it, and index finds its position again.
+    CompactTrack makes a fresh view on each access, so Refs to one are positional.'''
+
+    __slots__ = ['song', 'track_index', 'deltamsg_index', 'deltamsg']
+
+    def __init__(self, song, track_index, deltamsg_index, deltamsg=None):
         self.song = song
         self.track_index = track_index
         self.deltamsg_index = deltamsg_index
-        self.deltamsg = None
+        self.deltamsg = deltamsg
 
     def __call__(self):
         if self.deltamsg:
             return self.deltamsg
-        else:
-            return self.track()[self.deltamsg_index]
+        track = self.track()
+        deltamsg = track[self.deltamsg_index]
+        if isinstance(track, Track):
+            self.deltamsg = deltamsg
+        return deltamsg
 
     def track(self):
         return self.song[self.track_index]
 
+    def index(self):
+        'The index of the deltamsg in its track, found again if edits have moved it.'
+        if not self.deltamsg: return self.deltamsg_index
+        track = self.track()
+        i = self.deltamsg_index
+        if i == None or i >= len(track) or track[i] is not self.deltamsg:
+            i = self.deltamsg_index = track.find(self.deltamsg.ticks, id(self.deltamsg))
+        return i
+
     def remove(self):
-        self.denorm()
-        if self.deltamsg.note_end:
-            self.deltamsg.note_end.remove()
-        del self.track()[self.deltamsg_index]
-        self.track()[self.deltamsg_index].redelta()
+        'Remove the deltamsg, and its note end if it has one. The Ref still returns the removed deltamsg.'
+        deltamsg = self()
+        if deltamsg.note_end:
+            deltamsg.note_end.remove()
+        self.track().remove(self.index())
         self.deltamsg_index = None
 
     def denorm(self):
@@ -585,33 +1961,975 @@ class SongIter:
     'Song iterator to iterate over events in multiple tracks.'
 
     def __init__(self, song):
-        self.iters = [TrackIter(track) for track in song]
+        self.tracks = list(song)
+
+    def __iter__(self):
+        for ticks, track_index, deltamsg in merge(*self.tracks):
+            yield deltamsg
+
+class Stream:
+    '''A lazy pipeline over the msgs of one or more tracks, usually made by Song.stream.
+    Each stage wraps the generators of the stage before, so msgs are pulled through one at a time and no intermediate track is built.
+    Msgs flow as Deltamsgs with absolute ticks. Their deltas aren't kept up to date, and are only worked out at a sink: to_track, to_song, events or save.
+    Stages can pass on the source tracks' own Deltamsgs, so map functions should return new msgs rather than change the ones they get.
+    A stream can be consumed once.'''
+
+    def __init__(self, tracks, ticks_per_quarter=360, format=1, stats=None):
+        'tracks is a list with an iterable of Deltamsgs, with ticks, for each track. stats is a Stats to record save in, or None.'
+        self.tracks = tracks
+        self.ticks_per_quarter = ticks_per_quarter
+        self.format = format
+        self.stats = stats
+
+    def __len__(self):
+        return len(self.tracks)
 
     def __iter__(self):
-        while not all(i.stopped() for i in self.iters):
-            delta = min(i.delta() for i in self.iters)
-            for j in [i.advance(delta) for i in self.iters]:
-                if deltamsg := j:
-                    yield deltamsg
+        'Yield the msgs of every track in time order.'
+        if len(self.tracks) == 1: return iter(self.tracks[0])
+        return _stream_merge(self.tracks, False)
+
+    def filter(self, predicate):
+        return Stream([(i for i in track if predicate(i)) for track in self.tracks], self.ticks_per_quarter, self.format, self.stats)
+
+    def map(self, f):
+        '''Replace each msg with f(deltamsg). f can return a Msg, which takes the ticks of the msg it replaces, a Deltamsg with its own ticks, or None to drop the msg.
+        Ticks within a track must not go backwards.'''
+        return Stream([_stream_map(track, f) for track in self.tracks], self.ticks_per_quarter, self.format, self.stats)
+
+    def interleave(self):
+        '''Merge the tracks into one in time order, like interleave.
+        The end of track msgs of the tracks are dropped, and one is added at the end, at the latest ticks any track reached.'''
+        return Stream([_stream_merge(self.tracks)], self.ticks_per_quarter, self.format, self.stats)
+
+    def events(self, track_index=0):
+        'Yield (delta, bytes) for each msg of a track, as consumed by write_track.'
+        ticks_last = 0
+        for deltamsg in self.tracks[track_index]:
+            yield (deltamsg.ticks - ticks_last, deltamsg.bytes)
+            ticks_last = deltamsg.ticks
+
+    def to_track(self):
+        'Make a Track of new Deltamsgs from a stream of one track. Notes are not paired; see to_song.'
+        if len(self.tracks) != 1:
+            raise Exception('only a stream of one track can become a track, so interleave first')
+        result = Track()
+        ticks_last = 0
+        for deltamsg in self.tracks[0]:
+            result.deltamsgs.append(Deltamsg(deltamsg.ticks - ticks_last, deltamsg.bytes, deltamsg.ticks))
+            ticks_last = deltamsg.ticks
+        result.edits += 1
+        return result
+
+    def to_song(self, overlap='fifo'):
+        'Make a Song with a Track for each track of the stream, with notes paired.'
+        song = Song(ticks_per_quarter=self.ticks_per_quarter, track_count=0)
+        song.format = self.format
+        for track in self.tracks:
+            song.tracks.append(Stream([track]).to_track())
+            song.pair_notes(len(song.tracks) - 1, overlap)
+        return song
+
+    def save(self, file, running_status=False):
+        '''Write a MIDI file to a path or to any writable file object, pulling msgs through the pipeline as each track is written.
+        Like Song.save, only one track's bytes are held at once.'''
+        if isinstance(file, (str, os.PathLike)):
+            with open(file, 'wb') as f:
+                return self.save(f, running_status)
+        # a stream has the format, tracks and ticks_per_quarter that header_bytes needs
+        file.write(Song.header_bytes(self))
+        stats = self.stats
+        for track_index in range(len(self.tracks)):
+            # the pipeline runs as the track is serialized, so this phase includes every stage
+            if stats != None: record = stats.start('stream', track_index=track_index)
+            chunk = write_track(bytearray(), self.events(track_index), running_status)
+            if stats != None: stats.stop(record, bytes=len(chunk))
+            file.write(chunk)
+
+def _stream_map(track, f):
+    for deltamsg in track:
+        result = f(deltamsg)
+        if result is None: continue
+        if not isinstance(result, Deltamsg):
+            result = Deltamsg(None, result.bytes, deltamsg.ticks)
+        yield result
+
+def _stream_merge(tracks, end_of_track=True):
+    # like merge, but ranked by the ticks msgs carry, since deltas aren't kept up to date in a stream
+    ranked = [_ranked_ticks(track, track_index) for track_index, track in enumerate(tracks)]
+    ticks_end = 0
+    for ticks, rank, track_index, deltamsg in heapq.merge(*ranked):
+        ticks_end = ticks
+        if end_of_track and deltamsg.bytes[0] == 0xff and deltamsg.bytes[1] == 0x2f: continue
+        yield deltamsg
+    if end_of_track:
+        yield Deltamsg(None, (0xff, 0x2f, 0x00), ticks_end)
+
+def _ranked_ticks(track, track_index):
+    ticks_last = None
+    rank = 0
+    for deltamsg in track:
+        if deltamsg.ticks == ticks_last:
+            rank += 1
+        else:
+            ticks_last = deltamsg.ticks
+            rank = 0
+        yield (ticks_last, rank, track_index, deltamsg)
+
+def scan_chunk(buffer, start=0, end=None):
+    '''Yield (ticks, status, data start, data end) for each msg in buffer[start:end], the data of a track chunk.
+    This is the same decoding as CompactTrack.parse, which is kept separate so it can stay a tight loop.'''
+    if end == None: end = len(buffer)
+    ticks = 0
+    running_status = None
+    i = start
+    while i < end:
+        # delta
+        byte = buffer[i]
+        i += 1
+        if byte & 0x80:
+            delta = byte & 0x7f
+            for _ in range(3):
+                byte = buffer[i]
+                i += 1
+                delta = delta << 7 | byte & 0x7f
+                if not byte & 0x80: break
+            else: raise Exception('delta too big')
+            ticks += delta
+        else:
+            ticks += byte
+        # msg - status
+        status = buffer[i]
+        if status & 0x80:
+            i += 1
+            if status < 0xf0:
+                running_status = status
+        elif running_status == None:
+            raise Exception('no status')
+        else:
+            status = running_status
+        # msg - data
+        length = Msg.status_lengths[status]
+        if length != None:
+            data_end = i + length - 1
+        else:
+            data_end = system_msg_end(buffer, status, i)
+        if data_end > end: raise Exception('msg overruns track')
+        yield (ticks, status, i, data_end)
+        i = data_end
+
+def probe(file_path, count_events=True):
+    '''Read a MIDI file's header and chunk table without decoding msgs.
+    Returns a dict of format, track_count, ticks_per_quarter and chunk_sizes.
+    If count_events is true, event_counts holds the number of msgs in each track chunk, found by stepping over msgs by their lengths.'''
+    with open(file_path, 'rb') as file:
+        header = file.read(14)
+        if len(header) < 14 or header[:4] != b'MThd':
+            raise Exception('not a MIDI file')
+        file.seek(8 + int.from_bytes(header[4:8], 'big'))
+        result = {
+            'format': int.from_bytes(header[8:10], 'big'),
+            'track_count': int.from_bytes(header[10:12], 'big'),
+            'ticks_per_quarter': int.from_bytes(header[12:14], 'big'),
+            'chunk_sizes': [],
+        }
+        if count_events: result['event_counts'] = []
+        while True:
+            chunk_header = file.read(8)
+            if len(chunk_header) < 8: break
+            size = int.from_bytes(chunk_header[4:8], 'big')
+            result['chunk_sizes'].append(size)
+            if count_events and chunk_header[:4] == b'MTrk':
+                result['event_counts'].append(sum(1 for i in scan_chunk(file.read(size))))
+            else:
+                file.seek(size, os.SEEK_CUR)
+    return result
+
+def read_vlq(buffer, i):
+    'Read a variable-length quantity starting at buffer[i]. Returns (value, index after it).'
+    value = 0
+    for i in range(i, i+4):
+        value = value << 7 | buffer[i] & 0x7f
+        if not buffer[i] & 0x80: return (value, i+1)
+    raise Exception('variable-length quantity too big')
+
+def write_vlq(value):
+    'The bytes of value as a variable-length quantity.'
+    result = bytearray([value & 0x7f])
+    value >>= 7
+    while value:
+        result.insert(0, 0x80 | value & 0x7f)
+        value >>= 7
+    if len(result) > 4: raise Exception('variable-length quantity too big')
+    return bytes(result)
+
+def system_msg_end(buffer, status, i):
+    '''Find the end of a system msg whose data starts at buffer[i].
+    SysEx msgs (f0, and f7 escapes) are a variable-length size then data, and meta msgs are a type, a variable-length size, then data.'''
+    if status == 0xff:
+        size, i = read_vlq(buffer, i+1)
+    elif status in [0xf0, 0xf7]:
+        size, i = read_vlq(buffer, i)
+    else:
+        raise Exception(f'unhandled status {status:02x}')
+    return i + size
+
+def write_track(out, events, running_status=False):
+    '''Append a track chunk to the bytearray out and return out.
+    events is an iterable of (delta, msg bytes), like Track.events.
+    An end of track msg is added if the last msg isn't one.
+    If running_status is true, channel msg statuses equal to the previous one are omitted.'''
+    out += b'MTrk\0\0\0\0'
+    start = len(out)
+    status_last = None
+    bytes_ = None
+    for delta, bytes_ in events:
+        # delta
+        if delta < 0x80:
+            out.append(delta)
+        elif delta < 0x4000:
+            out.append(0x80 | delta >> 7)
+            out.append(delta & 0x7f)
+        elif delta < 0x10000000:
+            if delta >= 0x200000: out.append(0x80 | delta >> 21)
+            out.append(0x80 | delta >> 14 & 0x7f)
+            out.append(0x80 | delta >> 7 & 0x7f)
+            out.append(delta & 0x7f)
+        else:
+            raise Exception('delta too big')
+        # msg
+        status = bytes_[0]
+        if status >= 0xf0:
+            status_last = None
+        elif running_status and status == status_last:
+            out.extend(bytes_[1:])
+            continue
+        else:
+            status_last = status
+        out.extend(bytes_)
+    if bytes_ == None or tuple(bytes_) != (0xff, 0x2f, 0x00):
+        out += b'\x01\xff\x2f\x00'
+    out[start-4:start] = (len(out) - start).to_bytes(4, 'big')
+    return out
+
+def iter_chunk(buffer, start=0, end=None):
+    'Yield the Deltamsgs of a track chunk one at a time, without decoding the whole chunk.'
+    ticks_last = 0
+    for ticks, status, data_start, data_end in scan_chunk(buffer, start, end):
+        yield Deltamsg(ticks - ticks_last, (status, *buffer[data_start:data_end]), ticks)
+        ticks_last = ticks
+
+def pair_notes(notes, overlap='fifo'):
+    '''Pair note starts with note ends in a single pass.
+    notes is an iterable of (index, is_start, key) in track order, where key identifies a note, usually (channel, note).
+    Yields (start index, end index).
+    overlap decides what a note end closes when several notes with its key are open:
+    'fifo' closes the oldest, 'lifo' closes the newest, and 'all' closes all of them.
+    Note ends with no open note are ignored.'''
+    if overlap not in ['fifo', 'lifo', 'all']:
+        raise Exception(f'unknown overlap policy {overlap}')
+    opened = {}
+    for index, is_start, key in notes:
+        if is_start:
+            starts = opened.get(key)
+            if starts == None:
+                starts = opened[key] = collections.deque()
+            starts.append(index)
+            continue
+        starts = opened.get(key)
+        if not starts: continue
+        if overlap == 'fifo':
+            yield (starts.popleft(), index)
+        elif overlap == 'lifo':
+            yield (starts.pop(), index)
+        else:
+            while starts:
+                yield (starts.popleft(), index)
+
+def merge(*tracks):
+    '''Yield (ticks, track index, deltamsg) for the msgs of many tracks in time order, using a heap.
+    Msgs at the same ticks come one from each track in turn, and then around again, like stepping TrackIters together.
+    The deltamsgs are the tracks' own.'''
+    ranked = [_ranked(track, track_index) for track_index, track in enumerate(tracks)]
+    for ticks, rank, track_index, deltamsg in heapq.merge(*ranked):
+        yield (ticks, track_index, deltamsg)
+
+def _ranked(track, track_index):
+    # rank counts earlier msgs at the same ticks, so (ticks, rank, track_index) is unique and deltamsgs are never compared
+    ticks = 0
+    rank = -1
+    for deltamsg in track:
+        if deltamsg.delta:
+            ticks += deltamsg.delta
+            rank = 0
+        else:
+            rank += 1
+        yield (ticks, rank, track_index, deltamsg)
 
 def interleave(*tracks):
-    'Turn many tracks into one.'
+    'Turn many tracks into one. Msgs at the same ticks as the previous msg get a delta of 0.'
     result = Track()
-    iters = [TrackIter(i) for i in tracks]
-    while not all(i.stopped() for i in iters):
-        delta = min(i.delta() for i in iters)
-        first = True
-        for j in [i.advance(delta, True) for i in iters]:
-            if deltamsg := j:
-                if first:
-                    # advance by delta
-                    first = False
-                    result.append(deltamsg)
-                else:
-                    # these msgs happen at the same time, so zero delta
-                    result.append(Deltamsg(0, deltamsg.bytes))
+    ticks_last = 0
+    for ticks, track_index, deltamsg in merge(*tracks):
+        result.deltamsgs.append(Deltamsg(ticks - ticks_last, deltamsg.bytes, ticks))
+        ticks_last = ticks
     return result
 
+def song_layout(song, tempo_map=False):
+    '''Lay a song out for flat binary storage, as used by SongCache and SharedSong.
+    Returns (layout, buffers). layout is JSON-serializable, holding format, ticks_per_quarter, byteorder, and for each track a dict of column name to [offset, typecode, count].
+    If tempo_map is true, layout's tempo_map holds the same for the ticks, us and us_per_quarter of the song's TempoMap.
+    Each buffer belongs at its offset within the data area; offsets are 8-byte aligned, and size is the total.'''
+    layout = {
+        'format': song.format,
+        'ticks_per_quarter': song.ticks_per_quarter,
+        'byteorder': sys.byteorder,
+        'tracks': [],
+        'size': 0,
+    }
+    buffers = []
+    for track in song.tracks:
+        if not isinstance(track, CompactTrack):
+            track = CompactTrack.from_track(track)
+        columns = {}
+        for name, column in track.columns().items():
+            # columns are arrays, or memoryviews of them in a song from a layout, and payload is bytes
+            typecode = column.typecode if isinstance(column, array.array) else column.format if isinstance(column, memoryview) else 'B'
+            columns[name] = [layout['size'], typecode, len(column)]
+            buffers.append(column)
+            layout['size'] += -(-len(column) * array.array(typecode).itemsize // 8) * 8
+        layout['tracks'].append(columns)
+    if tempo_map:
+        tempo_map = song.tempo_map()
+        layout['tempo_map'] = {}
+        for name, typecode in [('ticks', 'q'), ('us', 'd'), ('us_per_quarter', 'q')]:
+            column = array.array(typecode, getattr(tempo_map, name))
+            layout['tempo_map'][name] = [layout['size'], typecode, len(column)]
+            buffers.append(column)
+            layout['size'] += -(-len(column) * column.itemsize // 8) * 8
+    return (layout, buffers)
+
+def write_layout(out, layout, buffers):
+    'Copy buffers into out, a writable buffer, at the offsets in layout.'
+    buffers = iter(buffers)
+    with memoryview(out) as view, view.cast('B') as out:
+        for columns in layout['tracks'] + [layout.get('tempo_map', {})]:
+            for name, (offset, typecode, count) in columns.items():
+                with memoryview(next(buffers)) as buffer, buffer.cast('B') as buffer:
+                    out[offset:offset+len(buffer)] = buffer
+
+def layout_header(layout, magic):
+    'The bytes before the data area of a layout: magic, the size of the layout as JSON, and the JSON, padded to a multiple of 8 bytes.'
+    layout_bytes = json.dumps(layout).encode()
+    header = magic + len(layout_bytes).to_bytes(4, 'big') + layout_bytes
+    return header + bytes(-len(header) % 8)
+
+def read_layout_header(buffer, magic):
+    'Read a header written by layout_header from the start of buffer. Returns (layout, data start).'
+    if bytes(buffer[:4]) != magic:
+        raise Exception(f'expected {magic}, but got {bytes(buffer[:4])}')
+    layout_size = int.from_bytes(buffer[4:8], 'big')
+    layout = json.loads(bytes(buffer[8:8+layout_size]))
+    return (layout, -(-(8 + layout_size) // 8) * 8)
+
+def song_from_layout(layout, data, copy=True):
+    '''Make a song of CompactTracks from a layout and its data area, as written by write_layout.
+    If copy is false, columns are memoryviews of data, so nothing is copied but the tracks can't be appended to, and can't be changed at all if data is read-only.
+    If the layout has a tempo map, it is used as the song's TempoMap until a track's tempo msgs change.'''
+    song = Song(ticks_per_quarter=layout['ticks_per_quarter'], track_count=0)
+    song.format = layout['format']
+    data = memoryview(data).cast('B')
+    def columns_of(columns):
+        result = {}
+        for name, (offset, typecode, count) in columns.items():
+            view = data[offset:offset+count*array.array(typecode).itemsize]
+            if copy and name == 'payload':
+                column = bytearray(view)
+            elif copy:
+                column = array.array(typecode)
+                column.frombytes(view)
+                if layout['byteorder'] != sys.byteorder:
+                    column.byteswap()
+            elif layout['byteorder'] != sys.byteorder:
+                raise Exception('byte order differs, so columns must be copied')
+            else:
+                column = view.cast(typecode)
+            result[name] = column
+        return result
+    for columns in layout['tracks']:
+        track = CompactTrack.from_columns(columns_of(columns))
+        track.song = song
+        track.track_index = len(song.tracks)
+        song.tracks.append(track)
+    if 'tempo_map' in layout:
+        tempo_map = TempoMap.__new__(TempoMap)
+        tempo_map.ticks_per_quarter = song.ticks_per_quarter
+        for name, column in columns_of(layout['tempo_map']).items():
+            setattr(tempo_map, name, column)
+        song.caches['tempo_map'] = ([(id(track), track.tempo_edits) for track in song.tracks], tempo_map)
+    data.release()
+    return song
+
+class SharedSong:
+    '''A song published in shared memory as read-only columns, so many processes can use it without each loading it.
+    The publisher makes one with SharedSong.publish, and other processes attach to it by name with SharedSong.attach.
+    Either way, song is a Song of CompactTracks whose columns are views of the shared memory, with its TempoMap already built.
+    select, SongIter, iteration and filter work on it. Its tracks are SharedTracks, so anything that would change one raises TypeError.
+    The publisher unlinks the memory when it closes, is garbage collected or exits; either way, the song's views are released first. The OS frees the memory once every process that attached has closed too, so attached processes can carry on until then.'''
+
+    def __init__(self, shared_memory, owner):
+        self.shared_memory = shared_memory
+        self.name = shared_memory.name
+        self.owner = owner
+        # views of shared memory must be released before it can be closed, so keep hold of it read-only, and of nothing else
+        self.view = shared_memory.buf.toreadonly()
+        layout, data_start = read_layout_header(self.view, b'DMLS')
+        self.song = song_from_layout(layout, self.view[data_start:], copy=False)
+        for track in self.song.tracks:
+            track.__class__ = SharedTrack
+        self.tracker = layout.get('tracker')
+        self.finalizer = weakref.finalize(self, SharedSong.release, self.song, self.view, shared_memory, owner)
+
+    def publish(song, name=None):
+        'Copy song into a new block of shared memory, named name or a random name. Returns the SharedSong of the publisher.'
+        layout, buffers = song_layout(song, True)
+        if os.name == 'posix': layout['tracker'] = _resource_tracker_id()
+        header = layout_header(layout, b'DMLS')
+        shared_memory = multiprocessing.shared_memory.SharedMemory(name, True, len(header) + layout['size'])
+        try:
+            with shared_memory.buf[:len(header)] as out: out[:] = header
+            with shared_memory.buf[len(header):] as out: write_layout(out, layout, buffers)
+            return SharedSong(shared_memory, True)
+        except:
+            shared_memory.close()
+            shared_memory.unlink()
+            raise
+
+    def attach(name):
+        'Attach to a song published under name. Returns a SharedSong whose song is a view of it.'
+        try:
+            shared_memory = multiprocessing.shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            shared_memory = multiprocessing.shared_memory.SharedMemory(name)
+            result = SharedSong(shared_memory, False)
+            # before Python 3.13, attaching registers the memory with this process's resource tracker, which would unlink it when this process exits.
+            # Processes started from the publisher, by fork, spawn or forkserver, share its tracker, where the registration is the publisher's own, so it's left alone there.
+            if os.name == 'posix' and result.tracker != _resource_tracker_id():
+                multiprocessing.resource_tracker.unregister(shared_memory._name, 'shared_memory')
+            return result
+        return SharedSong(shared_memory, False)
+
+    def release(song, view, shared_memory, unlink):
+        'Release the views of song and view, which must go before the memory can be unmapped, then unmap it, and unlink it if unlink is true.'
+        for track in song.tracks:
+            for column in track.columns().values():
+                column.release()
+        tempo_map = song.caches.get('tempo_map')
+        if tempo_map != None:
+            for column in [tempo_map[1].ticks, tempo_map[1].us, tempo_map[1].us_per_quarter]:
+                if isinstance(column, memoryview): column.release()
+        view.release()
+        shared_memory.close()
+        if unlink: shared_memory.unlink()
+
+    def close(self):
+        'Release song and unmap the memory. For the publisher, also unlink it. The song can no longer be used.'
+        self.song = None
+        self.finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class SharedTrack(CompactTrack):
+    '''A CompactTrack of a SharedSong, whose columns are read-only views of shared memory.
+    Changing a column in place already raises TypeError. Replacing one, or counting an edit, which everything that changes a track does, raises TypeError here too.'''
+
+    def __setattr__(self, name, value):
+        if name in CompactTrack.column_names or name in ['edits', 'tempo_edits']:
+            raise TypeError('tracks of a shared song are read-only')
+        object.__setattr__(self, name, value)
+
+def _resource_tracker_id():
+    # processes sharing a resource tracker share the pipe they write to it through, so the pipe identifies the tracker, even in spawned processes that don't know its pid
+    stat = os.fstat(multiprocessing.resource_tracker.getfd())
+    return f'{stat.st_dev}:{stat.st_ino}'
+
+# bump when parsing or song_layout changes, so cached songs are reparsed
+CACHE_VERSION = 1
+
+class SongCache:
+    '''Cache of parsed songs on disk, keyed by a hash of each file's contents, the cache version and the overlap policy.
+    An entry is a song's CompactTrack columns in a flat binary file, so a hit rebuilds the song without parsing MIDI.
+    Once the entries exceed max_bytes, the least recently used are evicted. Entries are listed once, when the cache is opened, and their total size is kept up to date from then on.
+    An entry that can't be read, like one cut short by a crash, counts as a miss and is rewritten.
+    The hash of each path is remembered in index.json against its size and modification time, so a hit on an unchanged file doesn't read the MIDI bytes.
+    index.json is written after every index_batch new paths, and by flush and close.
+    hits and misses count lookups.'''
+
+    def __init__(self, directory, max_bytes=1 << 30, index_batch=1000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_batch = index_batch
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(os.path.join(directory, 'index.json')) as file: self.index = json.load(file)
+        except (FileNotFoundError, ValueError):
+            self.index = {}
+        self.unwritten = 0
+        # entry name -> size, least recently used first
+        self.entries = collections.OrderedDict()
+        listed = []
+        for name in os.listdir(directory):
+            if not name.endswith('.songcache'): continue
+            stat = os.stat(os.path.join(directory, name))
+            listed.append((stat.st_mtime, name, stat.st_size))
+        for mtime, name, size in sorted(listed):
+            self.entries[name] = size
+        self.size = sum(self.entries.values())
+
+    def load(self, file_path, overlap='fifo', compact=True):
+        'Load a song through the cache. If compact is false, the song is expanded to Tracks.'
+        stat = os.stat(file_path)
+        path = os.path.realpath(file_path)
+        file_bytes = None
+        if self.index.get(path, [None])[:2] == [stat.st_size, stat.st_mtime_ns]:
+            key = self.index[path][2]
+        else:
+            with open(file_path, 'rb') as file: file_bytes = file.read()
+            key = hashlib.blake2b(file_bytes, digest_size=20).hexdigest()
+            self.index[path] = [stat.st_size, stat.st_mtime_ns, key]
+            self.unwritten += 1
+            if self.unwritten >= self.index_batch: self.flush()
+        name = f'{key}-{CACHE_VERSION}-{overlap}.songcache'
+        entry_path = os.path.join(self.directory, name)
+        try:
+            song = self.read(entry_path)
+            os.utime(entry_path)
+            if name in self.entries: self.entries.move_to_end(name)
+            self.hits += 1
+        except Exception:
+            # missing, or truncated or corrupt
+            self.misses += 1
+            if file_bytes == None:
+                with open(file_path, 'rb') as file: file_bytes = file.read()
+            song = Song(file_bytes=file_bytes, overlap=overlap, compact=True)
+            self.write(entry_path, song)
+            self.size -= self.entries.pop(name, 0)
+            self.entries[name] = os.stat(entry_path).st_size
+            self.size += self.entries[name]
+            self.evict()
+        if not compact: song.expand()
+        return song
+
+    def flush(self):
+        'Write index.json, if any paths were hashed since it was last written.'
+        if not self.unwritten: return
+        temp_path = os.path.join(self.directory, f'index.json.{os.getpid()}.tmp')
+        with open(temp_path, 'w') as file: json.dump(self.index, file)
+        os.replace(temp_path, os.path.join(self.directory, 'index.json'))
+        self.unwritten = 0
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read(self, entry_path):
+        with open(entry_path, 'rb') as file: entry = file.read()
+        layout, data_start = read_layout_header(entry, b'DMLC')
+        if len(entry) - data_start != layout['size']:
+            raise Exception(f'{entry_path} is {len(entry)} bytes, but its layout needs {data_start + layout["size"]}')
+        return song_from_layout(layout, memoryview(entry)[data_start:])
+
+    def write(self, entry_path, song):
+        layout, buffers = song_layout(song)
+        header = layout_header(layout, b'DMLC')
+        out = bytearray(header) + bytearray(layout['size'])
+        write_layout(memoryview(out)[len(header):], layout, buffers)
+        # write then rename, so readers never see a partial entry
+        temp_path = f'{entry_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as file: file.write(out)
+        os.replace(temp_path, entry_path)
+
+    def evict(self):
+        while self.size > self.max_bytes and self.entries:
+            name, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                # another process sharing the directory got to it first
+                pass
+
+def load_many(paths, workers=None, overlap='fifo'):
+    '''Load many MIDI files in a pool of worker processes.
+    Yields (path, song, exception) as each file finishes, in completion order.
+    Songs are loaded with compact=True, so they cross process boundaries as array columns rather than Deltamsgs and Refs.
+    If loading a file raises, song is None and exception is what was raised; the rest of the batch carries on.'''
+    yield from _pool(_load_compact, paths, workers, overlap)
+
+def _pool(f, paths, workers, *args):
+    if workers == None: workers = os.cpu_count() or 1
+    paths = iter(paths)
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        pending = set()
+        while True:
+            # keep a bounded number of files in flight so huge batches don't queue every path up front
+            for path in paths:
+                pending.add(executor.submit(f, path, *args))
+                if len(pending) >= 4 * workers: break
+            if not pending: return
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+def _load_compact(path, overlap):
+    try:
+        return (path, Song(path, overlap=overlap, compact=True), None)
+    except Exception as e:
+        return (path, None, e)
+
+def skyline(notes):
+    '''The melody of notes, (start ticks, end ticks, note, velocity, channel) as from Track.notes: the highest note starting at each ticks, as (ticks, note).
+    Notes on channel 10, the General MIDI drum channel, are left out.'''
+    highest = {}
+    for start, end, num, vel, channel in notes:
+        if channel == 9: continue
+        if num > highest.get(start, -1): highest[start] = num
+    return sorted(highest.items())
+
+class PatternIndex:
+    '''Persistent inverted index of melodic and rhythmic n-grams over many songs, in an SQLite database at path.
+    Each track's melody is its skyline. Every run of n melody notes is indexed two ways: by its pitch intervals, which don't change under transposition, and by its inter-onset intervals in twelfths of a quarter note.
+    A posting records the song's key, track index, note position and ticks, so hits can be turned into Refs with locate.
+    Songs can be added and removed at any time; each add or remove is one transaction.'''
+
+    def __init__(self, path, n=4):
+        self.db = sqlite3.connect(path)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS songs (id INTEGER PRIMARY KEY, key TEXT UNIQUE, notes INTEGER)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS grams (gram BLOB PRIMARY KEY, count INTEGER) WITHOUT ROWID')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS postings (gram BLOB, song INTEGER, track INTEGER, position INTEGER, ticks INTEGER, '
+                'PRIMARY KEY (gram, song, track, position)) WITHOUT ROWID'
+            )
+            self.db.execute('CREATE INDEX IF NOT EXISTS postings_song ON postings (song)')
+            self.db.execute('INSERT OR IGNORE INTO meta VALUES (?, ?)', ('n', n))
+        self.n = self.db.execute('SELECT value FROM meta WHERE key = ?', ('n',)).fetchone()[0]
+        if self.n != n:
+            raise Exception(f'index at {path} was built with n = {self.n}')
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM songs').fetchone()[0]
+
+    def __contains__(self, key):
+        return self.db.execute('SELECT 1 FROM songs WHERE key = ?', (key,)).fetchone() != None
+
+    def grams(self, onsets, nums, ticks_per_quarter):
+        'Yield (position, gram) for each run of n notes, a pitch gram and then, if onsets is not None, a rhythm gram.'
+        n = self.n
+        intervals = bytes((min(max(j - i, -0x7f), 0x7f)) & 0xff for i, j in zip(nums, nums[1:]))
+        if onsets != None:
+            iois = bytes(min(round((j - i) * 12 / ticks_per_quarter), 0xff) for i, j in zip(onsets, onsets[1:]))
+        for position in range(len(nums) - n + 1):
+            yield (position, b'p' + intervals[position:position+n-1])
+            if onsets != None:
+                yield (position, b'r' + iois[position:position+n-1])
+
+    def postings(self, song, song_id):
+        'Yield (gram, song id, track index, position, ticks) for each n-gram of each track of song.'
+        for track_index, track in enumerate(song):
+            melody = skyline(track.notes())
+            if len(melody) < self.n: continue
+            onsets, nums = zip(*melody)
+            for position, gram in self.grams(onsets, nums, song.ticks_per_quarter):
+                yield (gram, song_id, track_index, position, onsets[position])
+
+    def add(self, key, song=None):
+        'Index song under key, replacing whatever was indexed under key before. If song is None, key is a path to load it from.'
+        if song == None: song = Song(key, compact=True)
+        with self.db:
+            self._remove(key)
+            song_id = self.db.execute(
+                'INSERT INTO songs (key, notes) VALUES (?, ?)',
+                (key, sum(len(list(track.notes())) for track in song)),
+            ).lastrowid
+            postings = list(self.postings(song, song_id))
+            self.db.executemany('INSERT INTO postings VALUES (?, ?, ?, ?, ?)', postings)
+            self.db.executemany(
+                'INSERT INTO grams VALUES (?, ?) ON CONFLICT (gram) DO UPDATE SET count = count + excluded.count',
+                collections.Counter(i[0] for i in postings).items(),
+            )
+
+    def add_many(self, paths, workers=None):
+        '''Index many files under their paths, loading them in worker processes with load_many.
+        Returns a list of (path, exception) for files that failed to load.'''
+        failed = []
+        for path, song, exception in load_many(paths, workers):
+            if exception != None:
+                failed.append((path, exception))
+            else:
+                self.add(path, song)
+        return failed
+
+    def remove(self, key):
+        'Remove the song indexed under key, if there is one.'
+        with self.db:
+            self._remove(key)
+
+    def _remove(self, key):
+        row = self.db.execute('SELECT id FROM songs WHERE key = ?', (key,)).fetchone()
+        if row == None: return
+        counts = self.db.execute('SELECT COUNT(*), gram FROM postings WHERE song = ? GROUP BY gram', row).fetchall()
+        self.db.executemany('UPDATE grams SET count = count - ? WHERE gram = ?', counts)
+        self.db.execute('DELETE FROM grams WHERE count <= 0')
+        self.db.execute('DELETE FROM postings WHERE song = ?', row)
+        self.db.execute('DELETE FROM songs WHERE id = ?', row)
+
+    def search(self, nums, onsets=None, ticks_per_quarter=360, limit=10, max_postings=100000):
+        '''Find where a pattern of notes occurs, in any transposition.
+        nums is the pattern's notes in order. If onsets, the ticks each note starts at, is given, rhythm must match too.
+        Returns up to limit hits, best first, as (score, key, track index, ticks). score is the fraction of the pattern's n-grams found in order, and ticks is where the earliest of them starts.
+        Rarer n-grams are looked up first, and n-grams are skipped once max_postings postings have been read, so common patterns stay fast.'''
+        if len(nums) < self.n:
+            raise Exception(f'patterns need at least {self.n} notes')
+        grams = list(self.grams(onsets, nums, ticks_per_quarter))
+        counts = []
+        for position, gram in grams:
+            row = self.db.execute('SELECT count FROM grams WHERE gram = ?', (gram,)).fetchone()
+            # a gram of the pattern that's nowhere in the index can't help find it
+            if row != None: counts.append((row[0], position, gram))
+        scores = collections.Counter()
+        starts = {}
+        read = 0
+        for count, position, gram in sorted(counts):
+            if read and read + count > max_postings: break
+            read += count
+            for song_id, track_index, found, ticks in self.db.execute(
+                'SELECT song, track, position, ticks FROM postings WHERE gram = ?', (gram,)
+            ):
+                alignment = (song_id, track_index, found - position)
+                scores[alignment] += 1
+                if starts.get(alignment, (math.inf,))[0] > position:
+                    starts[alignment] = (position, ticks)
+        result = []
+        for alignment, score in scores.most_common(limit):
+            song_id, track_index, _ = alignment
+            key = self.db.execute('SELECT key FROM songs WHERE id = ?', (song_id,)).fetchone()[0]
+            result.append((score / len(grams), key, track_index, starts[alignment][1]))
+        return result
+
+    def locate(song, track_index, ticks):
+        'A Ref to the melody note of a hit: the highest note start at ticks in the track, leaving out channel 10.'
+        track = song[track_index]
+        best = None
+        i = bisect.bisect_left(track, ticks, key=lambda i: i.ticks)
+        while i < len(track) and track[i].ticks == ticks:
+            deltamsg = track[i]
+            if deltamsg.is_note_start() and deltamsg.channel() != 9:
+                if best == None or deltamsg.note() > track[best].note(): best = i
+            i += 1
+        if best == None: return None
+        return song.ref(track_index, best)
+
+def _mix64(x):
+    # the splitmix64 finalizer: a cheap 64-bit hash of an int that, unlike hash, is the same in every process and on every machine
+    x = (x ^ (x >> 30)) * 0xbf58476d1ce4e5b9 & 0xffffffffffffffff
+    x = (x ^ (x >> 27)) * 0x94d049bb133111eb & 0xffffffffffffffff
+    return x ^ (x >> 31)
+
+class Fingerprint:
+    '''Content fingerprint of a song's notes, unchanged by track order, channel assignment, tempo msgs, ticks_per_quarter, leading silence, and timing jitter smaller than the grid.
+    Notes of every track are merged, rescaled to resolution steps per quarter note, quantized, shifted to start at step 0, and ordered by start and pitch. Notes on channel 10, the General MIDI drum channel, are kept apart from pitched ones, and doubled notes count once.
+    digest is a hash of that canonical note list, equal for exact duplicates. signature is a MinHash of its note pairs, for estimating how similar two songs are; see LSH.'''
+
+    def __init__(self, digest, signature, notes):
+        self.digest = digest
+        self.signature = signature
+        self.notes = notes
+
+    def __repr__(self):
+        return f'Fingerprint({self.digest!r}, {self.notes} notes)'
+
+    def canonical(song, resolution=12):
+        '''The canonical note list of song, as sorted (step, key) where key is the note, plus 0x80 on channel 10.
+        Tracks are merged by sorting their notes together rather than through interleave, whose ties follow track order.'''
+        scale = resolution / song.ticks_per_quarter
+        notes = set()
+        for track in song:
+            # paired note starts come straight from the columns of compact tracks, with no Refs built
+            for start, end, num, vel, channel in track.notes():
+                notes.add((round(start * scale), num | 0x80 if channel == 9 else num))
+        notes = sorted(notes)
+        if notes:
+            first = notes[0][0]
+            notes = [(step - first, key) for step, key in notes]
+        return notes
+
+    def from_song(song, resolution=12, fanout=4, num_perm=128):
+        '''Fingerprint song, best loaded with compact=True.
+        Each note is paired with the fanout notes after it, and a pair is the two keys and their distance in steps, so it doesn't depend on where in the song the pair falls.
+        Jitter that moves a note across a step boundary only changes the pairs that note is in, so near-duplicates keep most of their pairs.
+        The signature uses one-permutation hashing: each pair is hashed once, the hash picks one of num_perm bins, and each bin keeps its smallest value.
+        Empty bins borrow from the next full one, so the signature has num_perm values whenever the song has two notes or more, and none otherwise.'''
+        notes = Fingerprint.canonical(song, resolution)
+        digest = hashlib.blake2b(digest_size=16)
+        mins = [None] * num_perm
+        width = (1 << 64) // num_perm
+        for i, (step, key) in enumerate(notes):
+            digest.update(step.to_bytes(4, 'little') + bytes([key]))
+            for other_step, other_key in notes[i+1:i+1+fanout]:
+                h = _mix64(key << 16 | other_key << 8 | min(other_step - step, 0xff))
+                b = h % num_perm
+                if mins[b] == None or h // num_perm < mins[b]: mins[b] = h // num_perm
+        signature = array.array('Q')
+        if any(i != None for i in mins):
+            for b in range(num_perm):
+                distance = 0
+                while mins[(b + distance) % num_perm] == None: distance += 1
+                # borrowed values are offset by how far they were borrowed from, so songs with different empty bins differ there
+                signature.append(mins[(b + distance) % num_perm] + distance * width)
+        return Fingerprint(digest.hexdigest(), signature, len(notes))
+
+    def from_file(path, resolution=12, fanout=4, num_perm=128):
+        'Fingerprint the MIDI file at path, loading it with compact=True and without sysex or meta msgs.'
+        return Fingerprint.from_song(Song(path, compact=True, sysex=False, meta=False), resolution, fanout, num_perm)
+
+    def from_files(paths, workers=None, resolution=12, fanout=4, num_perm=128):
+        '''Fingerprint many files in a pool of worker processes, like load_many.
+        Yields (path, fingerprint, exception) as each file finishes, in completion order. Only fingerprints cross process boundaries, not songs.'''
+        yield from _pool(_fingerprint_file, paths, workers, resolution, fanout, num_perm)
+
+    def similarity(self, other):
+        'Estimated Jaccard similarity of the two songs\' note pairs: the fraction of signature values that agree. 0 if either song has no pairs.'
+        if not self.signature or not other.signature: return 0.0
+        if len(self.signature) != len(other.signature):
+            raise Exception('signatures have different num_perm')
+        return sum(i == j for i, j in zip(self.signature, other.signature)) / len(self.signature)
+
+def _fingerprint_file(path, resolution, fanout, num_perm):
+    try:
+        return (path, Fingerprint.from_file(path, resolution, fanout, num_perm), None)
+    except Exception as e:
+        return (path, None, e)
+
+class LSH:
+    '''Locality-sensitive hashing of Fingerprints, to find near-duplicates in a corpus without comparing every pair.
+    Each signature is cut into bands of consecutive values, and songs whose signatures agree on a whole band share a bucket. Songs of similarity s share some bucket with probability 1 - (1 - s ** rows) ** bands, which with 32 bands of 4 rows is over 98% at s = 0.6 and under 25% at s = 0.3.
+    Candidates from buckets are checked against their signatures, so a lower bucket threshold costs comparisons, not wrong answers.
+    Exact duplicates are bucketed by digest as well, so songs too short for a signature are still caught.
+    Buckets only hold keys, and memory grows by about bands entries per song.'''
+
+    def __init__(self, bands=32):
+        self.bands = bands
+        self.fingerprints = {}
+        self.buckets = [{} for i in range(bands + 1)]
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def __contains__(self, key):
+        return key in self.fingerprints
+
+    def band_keys(self, fingerprint):
+        'Yield (band index, bucket key) for each band of fingerprint, then (bands, digest).'
+        signature = fingerprint.signature
+        if signature:
+            if len(signature) % self.bands:
+                raise Exception(f'signature length {len(signature)} is not a multiple of {self.bands} bands')
+            rows = len(signature) // self.bands
+            for band in range(self.bands):
+                yield (band, signature[band*rows:(band+1)*rows].tobytes())
+        yield (self.bands, fingerprint.digest)
+
+    def add(self, key, fingerprint):
+        'Add fingerprint under key, replacing whatever was under key before.'
+        self.remove(key)
+        self.fingerprints[key] = fingerprint
+        for band, bucket in self.band_keys(fingerprint):
+            self.buckets[band].setdefault(bucket, []).append(key)
+
+    def add_many(self, paths, workers=None):
+        '''Fingerprint many files with Fingerprint.from_files and add them under their paths.
+        Returns a list of (path, exception) for files that failed.'''
+        failed = []
+        for path, fingerprint, exception in Fingerprint.from_files(paths, workers):
+            if exception != None:
+                failed.append((path, exception))
+            else:
+                self.add(path, fingerprint)
+        return failed
+
+    def remove(self, key):
+        'Remove the fingerprint under key, if there is one.'
+        fingerprint = self.fingerprints.pop(key, None)
+        if fingerprint == None: return
+        for band, bucket in self.band_keys(fingerprint):
+            keys = self.buckets[band][bucket]
+            keys.remove(key)
+            if not keys: del self.buckets[band][bucket]
+
+    def candidates(self, fingerprint):
+        'The set of keys sharing a bucket with fingerprint.'
+        result = set()
+        for band, bucket in self.band_keys(fingerprint):
+            result.update(self.buckets[band].get(bucket, ()))
+        return result
+
+    def query(self, fingerprint, threshold=0.5):
+        '''Keys of near-duplicates of fingerprint, as (similarity, key), most similar first.
+        Candidates are checked against their signatures, and kept if their similarity is at least threshold or their digest is the same.'''
+        result = []
+        for key in self.candidates(fingerprint):
+            other = self.fingerprints[key]
+            similarity = 1.0 if other.digest == fingerprint.digest else fingerprint.similarity(other)
+            if similarity >= threshold: result.append((similarity, key))
+        return sorted(result, key=lambda i: -i[0])
+
+    def groups(self, threshold=0.5):
+        '''Group the keys into clusters of near-duplicates, as lists of two or more keys.
+        Keys are linked when they share a digest, or share a band and their similarity is at least threshold, and a cluster is everything linked directly or through other keys.
+        Keys of a digest bucket are exact duplicates, so they're linked without comparing them. In a band bucket, one key of each cluster found so far is compared with one of each other, so copies of a heavily duplicated song aren't compared pairwise.'''
+        parents = {key: key for key in self.fingerprints}
+        def find(key):
+            while parents[key] != key:
+                parents[key] = parents[parents[key]]
+                key = parents[key]
+            return key
+        for keys in self.buckets[self.bands].values():
+            root = find(keys[0])
+            for key in keys[1:]:
+                parents[find(key)] = root
+        for buckets in self.buckets[:self.bands]:
+            for keys in buckets.values():
+                # one key per cluster, so exact duplicates and keys already linked aren't compared again
+                roots = {}
+                for key in keys: roots.setdefault(find(key), key)
+                keys = list(roots.values())
+                for i, key in enumerate(keys):
+                    fingerprint = self.fingerprints[key]
+                    for other in keys[:i]:
+                        if find(key) == find(other): continue
+                        if fingerprint.similarity(self.fingerprints[other]) >= threshold:
+                            parents[find(key)] = find(other)
+        result = {}
+        for key in parents:
+            result.setdefault(find(key), []).append(key)
+        return [keys for keys in result.values() if len(keys) > 1]
+
 def print_vertical(*tracks):
     iters = [TrackIter(i) for i in tracks]
     ticks = 0